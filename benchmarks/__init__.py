@@ -0,0 +1,21 @@
+"""Benchmarks of the cogs.
+Run them from the root of the repository, with
+`python -m benchmarks.<name> --help` to see their options.
+"""
+import sys
+import types
+
+try:
+    import config  # noqa: F401
+
+except ImportError:
+    # the cogs only read optional settings from it
+    sys.modules["config"] = types.ModuleType("config")
+
+
+def percentile(values, percentile):
+    """Return the given percentile of the values."""
+
+    values = sorted(values)
+    index = min(len(values) - 1, int(percentile / 100 * len(values)))
+    return values[index]
@@ -0,0 +1,176 @@
+"""Measure the queries of the deletelog and editlog commands, on large
+moderation logs, before and after the migration of their tables.
+Fills a database with `--rows` deleted messages and `--edits` message
+revisions in the first version of the tables, times the queries of
+the commands, migrates the tables to the latest version, and times the
+queries again. Reports the percentiles of the queries, the duration of
+the migration, and the size of the tables.
+Needs discord-ext-menus.
+"""
+import argparse
+import asyncio
+import os
+import random
+import sqlite3
+import tempfile
+import time
+import types
+
+import aiosqlite
+
+from cogs.Moderation import schema
+from cogs.Moderation.moderation import Moderation
+from cogs.Moderation.writer import LogWriter
+from . import percentile
+
+
+# a year of messages, in the format of the first version
+FILL_DELETELOG = """
+    WITH RECURSIVE n(i) AS (
+        SELECT 0 UNION ALL SELECT i + 1 FROM n WHERE i < :rows - 1
+    )
+    INSERT INTO moderation_deletelog
+    SELECT i % :channels,
+           1,
+           i,
+           strftime('%Y-%m-%d %H:%M:%f', 1.6e9 + i * 3.1536e7 / :rows,
+                    'unixepoch'),
+           'message ' || i,
+           abs(random()) % :users,
+           NULL
+      FROM n
+"""
+
+FILL_EDITLOG = """
+    WITH RECURSIVE n(i) AS (
+        SELECT 0 UNION ALL SELECT i + 1 FROM n WHERE i < :rows - 1
+    )
+    INSERT INTO moderation_editlog
+    SELECT (i / :revisions) % :channels,
+           i / :revisions,
+           strftime('%Y-%m-%d %H:%M:%f', 1.6e9 + i * 3.1536e7 / :rows,
+                    'unixepoch'),
+           1,
+           'before ' || i,
+           'after ' || i,
+           abs(random()) % :users,
+           NULL
+      FROM n
+"""
+
+
+async def table_size(db):
+    """Return the bytes used by the pages of the database."""
+
+    sizes = []
+    for pragma in ("page_count", "freelist_count", "page_size"):
+        async with db.execute(f"PRAGMA {pragma}") as c:
+            sizes.append((await c.fetchone())[0])
+
+    page_count, freelist_count, page_size = sizes
+    return (page_count - freelist_count) * page_size
+
+
+async def time_queries(cog, args, count):
+    """Time `count` queries of each command, for random members,
+    channels and messages.
+    """
+    rng = random.Random(args.seed)
+    messages = args.edits // args.revisions
+    queries = {
+        "deletelog member": lambda: cog._get_deleted_messages_member(
+            types.SimpleNamespace(id=rng.randrange(args.users)), args.amount),
+        "deletelog channel": lambda: cog._get_deleted_messages_channel(
+            types.SimpleNamespace(id=rng.randrange(args.channels)),
+            args.amount),
+        "editlog": lambda: edited_messages(rng.randrange(messages)),
+    }
+
+    def edited_messages(message_id):
+        return cog._get_edited_messages(message_id, message_id % args.channels)
+
+    timings = {}
+    for name, query in queries.items():
+        timings[name] = []
+        for _ in range(count):
+            start = time.perf_counter()
+            await query()
+            timings[name].append(time.perf_counter() - start)
+
+    return timings
+
+
+def print_timings(timings):
+    print(f"{'query':<20}{'count':>7}{'p50':>10}{'p99':>10}{'max':>10}  (ms)")
+    for name, values in timings.items():
+        print(
+            f"{name:<20}{len(values):>7}"
+            f"{percentile(values, 50) * 1000:>10.3f}"
+            f"{percentile(values, 99) * 1000:>10.3f}"
+            f"{max(values) * 1000:>10.3f}"
+        )
+
+
+async def main(args):
+    path = args.db or os.path.join(tempfile.mkdtemp(), "moderation.db")
+    db = await aiosqlite.connect(path)
+    db.row_factory = sqlite3.Row
+    # the getters of the cog, without the rest of the bot
+    cog = types.SimpleNamespace(
+        bot=types.SimpleNamespace(db=db), log_writer=LogWriter(db))
+    for name in ("_get_deleted_messages_member",
+                 "_get_deleted_messages_channel",
+                 "_get_edited_messages"):
+        setattr(cog, name, getattr(Moderation, name).__get__(cog))
+
+    await schema.migrate(db, version=1)
+    start = time.perf_counter()
+    parameters = dict(users=args.users, channels=args.channels,
+                      revisions=args.revisions)
+    await db.execute(FILL_DELETELOG, dict(parameters, rows=args.rows))
+    await db.execute(FILL_EDITLOG, dict(parameters, rows=args.edits))
+    await db.commit()
+    print(
+        f"{args.rows} deleted messages and {args.edits} revisions "
+        f"written in {time.perf_counter() - start:.1f} s, "
+        f"{await table_size(db) / 2**20:.0f} MiB, in {path}"
+    )
+
+    print("\nVersion 1")
+    print_timings(await time_queries(cog, args, args.old_queries))
+
+    start = time.perf_counter()
+    await schema.migrate(db)
+    print(
+        f"\nMigrated to version {schema.LATEST_VERSION} in "
+        f"{time.perf_counter() - start:.1f} s, "
+        f"{await table_size(db) / 2**20:.0f} MiB"
+    )
+    print_timings(await time_queries(cog, args, args.queries))
+
+    await db.close()
+    if args.db is None:
+        os.remove(path)
+        os.rmdir(os.path.dirname(path))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=10**7,
+                        help="deleted messages in the log")
+    parser.add_argument("--edits", type=int, default=10**6,
+                        help="message revisions in the log")
+    parser.add_argument("--revisions", type=int, default=3,
+                        help="revisions of each edited message")
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--channels", type=int, default=100)
+    parser.add_argument("--amount", type=int, default=10,
+                        help="deleted messages asked for")
+    parser.add_argument("--queries", type=int, default=1000,
+                        help="queries of each command, after the migration")
+    parser.add_argument("--old-queries", type=int, default=3,
+                        help="queries of each command, before the migration")
+    parser.add_argument("--db", help="database to fill, kept afterwards")
+    parser.add_argument("--seed", type=int, default=0)
+
+    asyncio.run(main(parser.parse_args()))
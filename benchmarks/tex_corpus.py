@@ -0,0 +1,23 @@
+"""Fixed corpus of equations for the TeX benchmarks."""
+
+EQUATIONS = [
+    r"e^{i\pi} + 1 = 0",
+    r"E = mc^2",
+    r"F = ma",
+    r"i\hbar\frac{\partial}{\partial t}\Psi = \hat{H}\Psi",
+    r"\nabla \cdot \mathbf{E} = \frac{\rho}{\varepsilon_0}",
+    r"\nabla \times \mathbf{B} = \mu_0\mathbf{J}"
+    r" + \mu_0\varepsilon_0\frac{\partial \mathbf{E}}{\partial t}",
+    r"\int_{-\infty}^{\infty} e^{-x^2}\,dx = \sqrt{\pi}",
+    r"\sum_{n=1}^{\infty} \frac{1}{n^2} = \frac{\pi^2}{6}",
+    r"\frac{d}{dx}\left(\int_a^x f(t)\,dt\right) = f(x)",
+    r"\begin{pmatrix} a & b \\ c & d \end{pmatrix}"
+    r"\begin{pmatrix} x \\ y \end{pmatrix}",
+    r"Z = \sum_i g_i e^{-\beta E_i}",
+    r"\mathcal{L} = \bar\psi(i\gamma^\mu D_\mu - m)\psi"
+    r" - \frac{1}{4}F_{\mu\nu}F^{\mu\nu}",
+    r"\oint_C \mathbf{B}\cdot d\boldsymbol{\ell} = \mu_0 I_{\text{enc}}",
+    r"\lim_{x \to 0} \frac{\sin x}{x} = 1",
+    r"\Delta x\,\Delta p \geq \frac{\hbar}{2}",
+    r"S = k_B \ln \Omega",
+]
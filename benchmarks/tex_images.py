@@ -0,0 +1,86 @@
+"""Report the size of the equation images before and after their
+optimization, on a fixed corpus of equations.
+Needs the TeX tools of the compared backend.
+"""
+import argparse
+import asyncio
+import tempfile
+import time
+
+from . import tex_corpus
+from cogs.TeX import tex
+from cogs.TeX.image import ImageOptions
+from cogs.TeX.renderers import RENDERERS
+
+
+async def render_corpus(name, image_options, args):
+    """Return the images of the corpus and the time it took to render
+    them, in seconds.
+    """
+    with tempfile.TemporaryDirectory() as temp_path:
+        renderer = RENDERERS[name](
+            tex.LATEX_FILE,
+            temp_path,
+            f"{temp_path}/format",
+            pool_size=0,
+            dpi=args.dpi,
+            image_options=image_options,
+        )
+
+        images = []
+        start = time.perf_counter()
+        for i, equation in enumerate(tex_corpus.EQUATIONS):
+            page = tex.LATEX_EQUATION.replace("%equation%", equation)
+            image, = await renderer.render(page, 1, f"bench_{i}")
+            images.append(image)
+
+        return images, time.perf_counter() - start
+
+
+async def main(args):
+    optimized_options = ImageOptions(
+        levels=args.colors,
+        padding=args.padding,
+        transparent=args.transparent,
+    )
+    raw, raw_time = await render_corpus(
+        args.renderer, ImageOptions(optimize=False), args)
+    optimized, optimized_time = await render_corpus(
+        args.renderer, optimized_options, args)
+
+    print(
+        f"{args.renderer} renderer at {args.dpi} DPI, "
+        f"optimized as {optimized_options}"
+    )
+    print(f"{'equation':<40}{'before (B)':>12}{'after (B)':>12}{'ratio':>8}")
+    total_raw = total_optimized = 0
+    for equation, before, after in zip(tex_corpus.EQUATIONS, raw, optimized):
+        if before is None or after is None:
+            print(f"{equation[:38]:<40}{'failed':>12}")
+            continue
+
+        total_raw += len(before)
+        total_optimized += len(after)
+        print(
+            f"{equation[:38]:<40}{len(before):>12}{len(after):>12}"
+            f"{len(before) / len(after):>7.1f}x"
+        )
+
+    print(
+        f"{'total':<40}{total_raw:>12}{total_optimized:>12}"
+        f"{total_raw / max(total_optimized, 1):>7.1f}x"
+    )
+    print(
+        f"render time: {raw_time:.2f} s before, {optimized_time:.2f} s after"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--renderer", default="pdf", choices=RENDERERS)
+    parser.add_argument("--dpi", type=int, default=tex.RENDER_DPI)
+    parser.add_argument("--colors", type=int, default=tex.IMAGE_COLORS)
+    parser.add_argument("--padding", type=int, default=tex.IMAGE_PADDING)
+    parser.add_argument("--transparent", action="store_true")
+
+    asyncio.run(main(parser.parse_args()))
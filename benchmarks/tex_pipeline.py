@@ -0,0 +1,188 @@
+"""Measure the TeX cog end to end, from `on_message` to the reply, on a
+fixed corpus of equations. Messages are sent by a number of concurrent
+members, each waiting for its reply before sending the next message,
+and replying only waits for `--upload-latency`.
+Reports the percentiles of every stage of the renders, the throughput
+at each concurrency level and the peak memory usage.
+Needs the TeX tools of the chosen backend.
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import tempfile
+import time
+import types
+
+import aiosqlite
+
+from . import percentile, tex_corpus
+from cogs.TeX import tex
+
+try:
+    import resource
+
+except ImportError:
+    # not available on Windows
+    resource = None
+
+
+STAGES = ("queue", "write", "compile", "convert", "read", "optimize",
+          "upload", "total")
+
+
+class FakeMessage:
+    """Message with just what the cog uses, whose replies only wait."""
+
+    _ids = itertools.count(1)
+
+    def __init__(self, content, member, upload_latency, timings):
+        self.id = next(self._ids)
+        self.content = content
+        self.author = types.SimpleNamespace(id=member, bot=False)
+        self.channel = types.SimpleNamespace(id=member)
+        self.upload_latency = upload_latency
+        self.timings = timings
+
+    async def reply(self, content=None, files=None):
+        start = time.perf_counter()
+        for file in files or []:
+            file.fp.read()
+        await asyncio.sleep(self.upload_latency)
+        self.timings["upload"].append(time.perf_counter() - start)
+
+
+async def make_cog(temp_path, args):
+    """Return the cog, configured to write in `temp_path`, with an empty
+    database.
+    """
+
+    tex.LATEX_TEMP_PATH = f"{temp_path}/temp"
+    tex.LATEX_CACHE_PATH = f"{temp_path}/cache"
+    tex.LATEX_FORMAT_PATH = f"{temp_path}/format"
+    tex.RENDERER = args.renderer
+    tex.WORKER_POOL_SIZE = args.pool_size
+    tex.RENDER_CONCURRENCY = args.render_concurrency
+    tex.RENDER_QUEUE_SIZE = max(args.concurrency)
+    tex.DISKLESS = args.diskless
+    tex.SCRATCH_PATH = temp_path
+
+    os.makedirs(tex.LATEX_TEMP_PATH, exist_ok=True)
+    db = await aiosqlite.connect(":memory:")
+    return tex.TeX(types.SimpleNamespace(db=db))
+
+
+async def run_level(cog, concurrency, args, counter):
+    """Send the corpus from `concurrency` members at the same time, and
+    return the timings of the stages and the throughput.
+    """
+    timings = {"upload": [], "total": []}
+    cog.renderer.timings.clear()
+    cog.scheduler.waits.clear()
+
+    messages = []
+    for i in range(args.repeat):
+        for equation in tex_corpus.EQUATIONS:
+            if not args.cached:
+                # a different equation every time, but the same image
+                equation = f"{equation}\\vphantom{{{next(counter)}}}"
+            messages.append(f"`${equation}$`")
+
+    async def member(member_id):
+        while messages:
+            message = FakeMessage(
+                messages.pop(), member_id, args.upload_latency / 1000, timings)
+            start = time.perf_counter()
+            await cog.on_message(message)
+            timings["total"].append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(member(i) for i in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    timings.update(cog.renderer.timings)
+    timings["queue"] = cog.scheduler.waits
+    return timings, len(timings["total"]) / elapsed
+
+
+def peak_rss():
+    """Return the peak resident memory of the benchmark and of its
+    largest child process, in MiB.
+    """
+    if resource is None:
+        return None, None
+
+    # kilobytes on Linux
+    return (
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+    )
+
+
+async def main(args):
+    with tempfile.TemporaryDirectory() as temp_path:
+        cog = await make_cog(temp_path, args)
+        await cog._start_pool.get_task()
+        await cog._prewarm.get_task()
+
+        print(
+            f"{cog.renderer.identity}, "
+            f"{len(tex_corpus.EQUATIONS)} equations x {args.repeat}, "
+            f"{args.pool_size} warm workers, "
+            f"{'diskless' if args.diskless else 'on disk'}, "
+            f"{'cached' if args.cached else 'uncached'}"
+        )
+
+        counter = itertools.count()
+        for concurrency in args.concurrency:
+            timings, throughput = await run_level(
+                cog, concurrency, args, counter)
+
+            print(
+                f"\n{concurrency} concurrent members: "
+                f"{throughput:.1f} messages/s"
+            )
+            print(
+                f"{'stage':<10}{'count':>7}{'p50 (ms)':>10}{'p95 (ms)':>10}"
+                f"{'p99 (ms)':>10}"
+            )
+            for stage in STAGES:
+                values = timings.get(stage)
+                if not values:
+                    continue
+
+                print(
+                    f"{stage:<10}{len(values):>7}"
+                    f"{percentile(values, 50) * 1000:>10.1f}"
+                    f"{percentile(values, 95) * 1000:>10.1f}"
+                    f"{percentile(values, 99) * 1000:>10.1f}"
+                )
+
+        await cog.cog_unload()
+        await cog.bot.db.close()
+
+    own, children = peak_rss()
+    if own is not None:
+        print(
+            f"\nPeak RSS: {own:.1f} MiB, "
+            f"largest TeX process: {children:.1f} MiB"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--renderer", default=tex.RENDERER,
+                        choices=tex.RENDERERS)
+    parser.add_argument("--concurrency", nargs="+", type=int,
+                        default=[1, 2, 4, 8])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--pool-size", type=int, default=2)
+    parser.add_argument("--render-concurrency", type=int,
+                        default=tex.RENDER_CONCURRENCY)
+    parser.add_argument("--upload-latency", type=float, default=0,
+                        help="milliseconds each reply takes")
+    parser.add_argument("--diskless", action="store_true")
+    parser.add_argument("--cached", action="store_true",
+                        help="render each equation only once")
+
+    asyncio.run(main(parser.parse_args()))
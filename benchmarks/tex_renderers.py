@@ -0,0 +1,83 @@
+"""Compare the latency and the output size of the TeX render backends
+on a fixed corpus of equations, one equation per render.
+Needs the TeX tools of every compared backend.
+"""
+import argparse
+import asyncio
+import statistics
+import tempfile
+import time
+
+from . import percentile, tex_corpus
+from cogs.TeX import tex
+from cogs.TeX.renderers import RENDERERS
+
+
+async def bench_renderer(name, args):
+    with tempfile.TemporaryDirectory() as temp_path:
+        renderer = RENDERERS[name](
+            tex.LATEX_FILE,
+            temp_path,
+            f"{temp_path}/format",
+            scratch_path=temp_path if args.diskless else None,
+            pool_size=args.pool_size,
+            dpi=args.dpi,
+        )
+        await renderer.start()
+
+        latencies = []
+        sizes = []
+        failures = 0
+        for i in range(args.repeat):
+            for j, equation in enumerate(tex_corpus.EQUATIONS):
+                page = tex.LATEX_EQUATION.replace("%equation%", equation)
+                start = time.perf_counter()
+                image, = await renderer.render(page, 1, f"bench_{i}_{j}")
+                latencies.append(time.perf_counter() - start)
+
+                if image is None:
+                    failures += 1
+                else:
+                    sizes.append(len(image))
+
+        renderer.close()
+
+    return dict(
+        name=renderer.identity,
+        p50=percentile(latencies, 50) * 1000,
+        p95=percentile(latencies, 95) * 1000,
+        mean=statistics.mean(latencies) * 1000,
+        size=statistics.mean(sizes) if sizes else 0,
+        failures=failures,
+    )
+
+
+async def main(args):
+    print(
+        f"{len(tex_corpus.EQUATIONS)} equations x {args.repeat}, "
+        f"{args.pool_size} warm workers, "
+        f"{'diskless' if args.diskless else 'on disk'}"
+    )
+    print(
+        f"{'renderer':<26}{'p50 (ms)':>10}{'p95 (ms)':>10}{'mean (ms)':>11}"
+        f"{'size (B)':>10}{'failed':>8}"
+    )
+    for name in args.renderers:
+        result = await bench_renderer(name, args)
+        print(
+            f"{result['name']:<26}{result['p50']:>10.1f}{result['p95']:>10.1f}"
+            f"{result['mean']:>11.1f}{result['size']:>10.0f}"
+            f"{result['failures']:>8}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--renderers", nargs="+", default=list(RENDERERS), choices=RENDERERS)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--dpi", type=int, default=tex.RENDER_DPI)
+    parser.add_argument("--pool-size", type=int, default=2)
+    parser.add_argument("--diskless", action="store_true")
+
+    asyncio.run(main(parser.parse_args()))
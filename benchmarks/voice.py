@@ -0,0 +1,363 @@
+"""Simulate the rush at the end of a class against the Voice cog, offline.
+`--members` members join the numbered voice channels of `--groups`
+categories during the first half of `--duration` seconds, some move to
+another channel, and all of them leave by the end. The guild and its
+channels are fakes that record the API calls made by the cog, answer
+after `--api-latency`, and send the channel events back after
+`--gateway-delay`, like Discord would. Times are divided by `--speed`.
+Reports, for each number of spare channels, the time spent in the
+voice state handler, the API calls made, the members that found no
+empty channel, and the broken invariants: channel 1 deleted, an
+occupied channel deleted, duplicate numbers, or a wrong number of spare
+channels once the rush is over.
+"""
+import argparse
+import asyncio
+import itertools
+import random
+import time
+import types
+from collections import Counter
+
+import discord
+
+import config
+from cogs.Voice.index import parse_name
+from . import percentile
+
+
+CHANNEL_IDS = itertools.count(1)
+
+
+class FakeGuild:
+    """Guild with just what the cog uses, recording the API calls."""
+
+    def __init__(self, sim):
+        self.sim = sim
+        self.id = next(CHANNEL_IDS)
+        self.bitrate_limit = 96000
+        self._channels = {}
+
+    @property
+    def channels(self):
+        return list(self._channels.values())
+
+    @property
+    def voice_channels(self):
+        return [c for c in self.channels if isinstance(c, discord.VoiceChannel)]
+
+    def get_channel(self, channel_id):
+        return self._channels.get(channel_id)
+
+
+class FakeCategoryChannel(discord.CategoryChannel):
+    def __init__(self, guild, name, position):
+        self.guild = guild
+        self.id = next(CHANNEL_IDS)
+        self.name = name
+        self.position = position
+        self.category_id = None
+        guild._channels[self.id] = self
+
+    async def create_voice_channel(self, name, **kwargs):
+        sim = self.guild.sim
+        await sim.api_call("create")
+
+        if any(c.name == name for c in self.voice_channels):
+            sim.violations["duplicate number"] += 1
+
+        position = max((c.position for c in self.guild.voice_channels),
+                       default=-1) + 1
+        channel = FakeVoiceChannel(self.guild, name, self, position)
+        sim.dispatch("on_guild_channel_create", channel)
+        return channel
+
+    @property
+    def voice_channels(self):
+        return [c for c in self.guild.voice_channels if c.category_id == self.id]
+
+
+class FakeVoiceChannel(discord.VoiceChannel):
+    def __init__(self, guild, name, category, position):
+        self.guild = guild
+        self.id = next(CHANNEL_IDS)
+        self.name = name
+        self.position = position
+        self.category_id = category.id
+        self.connected = set()  # members in the channel, for Discord
+        self.cached = set()  # members in the channel, for the bot
+        guild._channels[self.id] = self
+
+    @property
+    def members(self):
+        return list(self.cached)
+
+    async def delete(self, **kwargs):
+        sim = self.guild.sim
+        await sim.api_call("delete")
+        if self.guild._channels.pop(self.id, None) is None:
+            raise discord.NotFound(
+                types.SimpleNamespace(status=404, reason="Not Found"),
+                "Unknown Channel",
+            )
+
+        if self.name.endswith(" 1"):
+            sim.violations["channel 1 deleted"] += 1
+        if self.connected:
+            sim.violations["occupied channel deleted"] += 1
+
+        sim.dispatch("on_guild_channel_delete", self)
+        # Discord disconnects the members left in the channel
+        for member in list(self.connected):
+            sim.dispatch_move(member, None)
+
+    async def edit(self, **kwargs):
+        await self.guild.sim.api_call("edit")
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+
+
+class FakeHTTP:
+    def __init__(self, guild):
+        self.guild = guild
+
+    async def bulk_channel_update(self, guild_id, data, reason=None):
+        sim = self.guild.sim
+        await sim.api_call("bulk position")
+        sim.positions += len(data)
+        for entry in data:
+            channel = self.guild.get_channel(entry["id"])
+            if channel is not None:
+                channel.position = entry["position"]
+
+
+class Simulation:
+    """A guild of `groups` categories with an "Étude 1" channel each,
+    and the Voice cog watching it.
+    """
+
+    def __init__(self, module, groups, args):
+        self.module = module
+        self.args = args
+        self.api_latency = args.api_latency / 1000 / args.speed
+        self.gateway_delay = args.gateway_delay / 1000 / args.speed
+
+        self.calls = Counter()
+        self.positions = 0
+        self.violations = Counter()
+        self.handler_times = []
+        self.no_spare = 0
+        self._tasks = set()
+
+        self.guild = FakeGuild(self)
+        self.categories = []
+        for i in range(groups):
+            category = FakeCategoryChannel(self.guild, f"Cours {i}", i)
+            FakeVoiceChannel(self.guild, "Étude 1", category, i)
+            self.categories.append(category)
+        FakeVoiceChannel(self.guild, "Général", self.categories[0], groups)
+
+        self.bot = types.SimpleNamespace(
+            guilds=[self.guild],
+            http=FakeHTTP(self.guild),
+            is_ready=lambda: True,
+        )
+        self.cog = module.Voice(self.bot)
+        self.location = {}  # member -> channel
+
+    async def api_call(self, kind):
+        self.calls[kind] += 1
+        await asyncio.sleep(self.api_latency)
+
+    def dispatch(self, event, *args):
+        """Call the listener of the cog after the gateway delay."""
+
+        async def send():
+            await asyncio.sleep(self.gateway_delay)
+            await getattr(self.cog, event)(*args)
+
+        task = asyncio.create_task(send())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def dispatch_move(self, member, channel):
+        """Move the member now, and send the voice state update to the
+        cog after the gateway delay.
+        """
+        before = self.location.pop(member, None)
+        if before is not None:
+            before.connected.discard(member)
+        if channel is not None:
+            channel.connected.add(member)
+            self.location[member] = channel
+
+        async def send():
+            await asyncio.sleep(self.gateway_delay)
+            # discord.py updates its cache right before the event
+            if before is not None:
+                before.cached.discard(member)
+            if channel is not None:
+                channel.cached.add(member)
+
+            start = time.perf_counter()
+            await self.cog.on_voice_state_update(
+                member,
+                types.SimpleNamespace(channel=before),
+                types.SimpleNamespace(channel=channel),
+            )
+            self.handler_times.append(time.perf_counter() - start)
+
+        task = asyncio.create_task(send())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def pick_channel(self, rng, category):
+        """Return an empty numbered channel of the category, or an
+        occupied one to join friends.
+        """
+        channels = [
+            c for c in category.voice_channels
+            if parse_name(c.name) is not None
+        ]
+        if rng.random() < self.args.join_friends:
+            occupied = [c for c in channels if c.connected]
+            if occupied:
+                return rng.choice(occupied)
+
+        empty = [c for c in channels if not c.connected]
+        if not empty:
+            self.no_spare += 1
+            return rng.choice(channels)
+
+        return min(empty, key=lambda c: parse_name(c.name)[1])
+
+    async def member(self, member, rng):
+        duration = self.args.duration / self.args.speed
+        join = rng.uniform(0, duration / 2)
+        leave = rng.uniform(join, duration)
+        category = rng.choice(self.categories)
+
+        await asyncio.sleep(join)
+        self.dispatch_move(member, self.pick_channel(rng, category))
+
+        if rng.random() < self.args.move_ratio:
+            await asyncio.sleep(rng.uniform(0, leave - join))
+            if member in self.location:
+                self.dispatch_move(member, self.pick_channel(rng, category))
+
+        await asyncio.sleep(max(0, leave - (time.perf_counter() - self.start)))
+        if member in self.location:
+            self.dispatch_move(member, None)
+
+    async def run(self):
+        rng = random.Random(self.args.seed)
+        # let the cog create the spare channels before the rush
+        await self.settle()
+        self.calls.clear()
+        self.positions = 0
+
+        self.start = time.perf_counter()
+        await asyncio.gather(*(
+            self.member(member, random.Random(rng.random()))
+            for member in range(self.args.members)
+        ))
+        await self.settle()
+        self.check_spares()
+        self.cog.cog_unload()
+
+    async def settle(self):
+        """Wait for the events in flight and for the reconciliations."""
+
+        while True:
+            await asyncio.gather(*self._tasks)
+            await self.cog.reconciler.join()
+            if not self._tasks:
+                break
+
+    def check_spares(self):
+        for category in self.categories:
+            numbers = Counter()
+            empty = 0
+            for channel in category.voice_channels:
+                parsed = parse_name(channel.name)
+                if parsed is None:
+                    continue
+                numbers[parsed[1]] += 1
+                empty += not channel.connected
+
+            if 1 not in numbers:
+                self.violations["channel 1 missing"] += 1
+            if any(n > 1 for n in numbers.values()):
+                self.violations["duplicate number"] += 1
+            # everyone left, only channel 1 is kept without spares
+            if empty != max(self.module.SPARE_CHANNELS, 1):
+                self.violations["wrong spare count"] += 1
+
+
+def load_cog_module(args):
+    from cogs.Voice import voice
+    voice.RECONCILE_DELAY = args.reconcile_delay / 1000 / args.speed
+    return voice
+
+
+async def main(args):
+    module = load_cog_module(args)
+
+    print(
+        f"{args.members} members in {args.groups} groups over "
+        f"{args.duration:.0f} s (run {args.speed:g}x faster), "
+        f"API latency {args.api_latency:.0f} ms"
+    )
+    for spares in args.spares:
+        config.voice_spare_channels = module.SPARE_CHANNELS = spares
+        sim = Simulation(module, args.groups, args)
+        await sim.run()
+
+        events = len(sim.handler_times)
+        calls = sum(sim.calls.values())
+        stats = sim.cog.reconciler.stats
+        print(f"\n{spares} spare channels: {events} voice state updates")
+        print(
+            f"Handler: p50 {percentile(sim.handler_times, 50) * 10**6:.0f} us, "
+            f"p99 {percentile(sim.handler_times, 99) * 10**6:.0f} us, "
+            f"max {max(sim.handler_times) * 10**6:.0f} us"
+        )
+        print(
+            f"Reconciliations: {stats['marked']} marked, {stats['runs']} runs, "
+            f"{stats['errors']} errors"
+        )
+        print(
+            f"API calls: {calls} ({calls / events:.2f} per update): "
+            + "".join(f"{n} {kind}, " for kind, n in sorted(sim.calls.items()))
+            + f"{sim.positions} positions sent"
+        )
+        print(f"Members without an empty channel: {sim.no_spare}")
+        if sim.violations:
+            print("Violations: " + ", ".join(
+                f"{n} {kind}" for kind, n in sorted(sim.violations.items())))
+        else:
+            print("Violations: none")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--members", type=int, default=100)
+    parser.add_argument("--groups", type=int, default=2)
+    parser.add_argument("--duration", type=float, default=60,
+                        help="seconds of the rush")
+    parser.add_argument("--speed", type=float, default=10,
+                        help="how many times faster than real time to run")
+    parser.add_argument("--spares", nargs="+", type=int, default=[1, 2])
+    parser.add_argument("--join-friends", type=float, default=0.5,
+                        help="chance to join an occupied channel")
+    parser.add_argument("--move-ratio", type=float, default=0.2,
+                        help="chance to move to another channel")
+    parser.add_argument("--api-latency", type=float, default=150,
+                        help="milliseconds to answer an API call")
+    parser.add_argument("--gateway-delay", type=float, default=50,
+                        help="milliseconds before the events are received")
+    parser.add_argument("--reconcile-delay", type=float, default=500,
+                        help="milliseconds the cog waits for a burst")
+    parser.add_argument("--seed", type=int, default=0)
+
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,230 @@
+"""Measure the Wolfram|Alpha cog offline, against the stand-in server of
+`benchmarks.wolfram_server`.
+Members send `--requests` queries drawn from `--queries` different ones,
+the most popular ones more often, as full or simple queries. Reports,
+at each concurrency level, the time to the first answer and to the
+complete one, the throughput, the requests that reached the server,
+the cache hits, and the time spent building the embeds.
+Needs aiowolframalpha.
+"""
+import argparse
+import asyncio
+import itertools
+import random
+import sqlite3
+import time
+import types
+
+import aiohttp
+import aiosqlite
+
+import config
+from . import wolfram_server
+from . import percentile
+
+
+class FakeMessage:
+    async def edit(self, **kwargs):
+        pass
+
+
+class FakeContext:
+    """Context with just what the commands use, timing the first reply."""
+
+    def __init__(self, member):
+        self.author = types.SimpleNamespace(id=member)
+        self.guild = None
+        self.first_reply = None
+
+    def typing(self):
+        return FakeTyping()
+
+    async def reply(self, content=None, **kwargs):
+        if self.first_reply is None:
+            self.first_reply = time.perf_counter()
+        return FakeMessage()
+
+
+class FakeTyping:
+    async def __aenter__(self):
+        pass
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+
+def load_cog_module(url, args):
+    """Configure the cog to use the server without limits, and return
+    its module.
+    """
+    config.wolfram_alpha_api = "benchmark"
+    config.wolfram_api_url = url
+    config.wolfram_rate = 10**6
+    config.wolfram_burst = 10**6
+    config.wolfram_queue_size = 10**6
+    config.wolfram_queue_size_member = 10**6
+    config.wolfram_monthly_quota = 10**9
+    config.wolfram_progressive = args.progressive
+
+    from cogs.WolframAlpha import wolframalpha
+    return wolframalpha
+
+
+def make_workload(args):
+    """Return the (mode, query) to send, with Zipf distributed queries."""
+
+    rng = random.Random(args.seed)
+    queries = [f"query {i}" for i in range(args.queries)]
+    weights = [1 / (rank + 1) for rank in range(args.queries)]
+    return [
+        ("simple" if rng.random() < args.simple_ratio else "full", query)
+        for query in rng.choices(queries, weights, k=args.requests)
+    ]
+
+
+async def run_level(module, session, server, concurrency, args):
+    """Send the workload from `concurrency` members, with a cold cog."""
+
+    db = await aiosqlite.connect(":memory:")
+    db.row_factory = sqlite3.Row
+    cog = module.WolframAlpha(types.SimpleNamespace(db=db, http_session=session))
+    await cog._create_tables.get_task()
+
+    embed_times = []
+    make_embed = cog.make_embed
+
+    def timed_make_embed(*args, **kwargs):
+        start = time.perf_counter()
+        embed = make_embed(*args, **kwargs)
+        embed_times.append(time.perf_counter() - start)
+        return embed
+
+    cog.make_embed = timed_make_embed
+
+    workload = make_workload(args)
+    timings = {"full": ([], []), "simple": ([], [])}  # (first, complete)
+    errors = 0
+    requests_before = server.requests.copy()
+    members = itertools.count()
+
+    async def member():
+        nonlocal errors
+        member_id = next(members)
+        while workload:
+            mode, query = workload.pop()
+            command = cog.wolfram if mode == "full" else cog.wolfram_simple
+            ctx = FakeContext(member_id)
+            start = time.perf_counter()
+            try:
+                await command.callback(cog, ctx, query=query)
+
+            except module.QueryError:
+                errors += 1
+                continue
+
+            first, complete = timings[mode]
+            first.append(ctx.first_reply - start)
+            complete.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(member() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    cog.cog_unload()
+    await db.close()
+
+    return dict(
+        timings=timings,
+        throughput=args.requests / elapsed,
+        errors=errors,
+        requests=server.requests - requests_before,
+        stats=dict(cog.stats, coalesced=cog.requests.stats["coalesced"]),
+        embed_times=embed_times,
+    )
+
+
+async def main(args):
+    server = wolfram_server.WolframServer(
+        latency=args.latency / 1000,
+        first_pods_latency=args.first_pods_latency / 1000,
+        simple_latency=args.simple_latency / 1000,
+        pods=args.pods,
+        image_size=args.image_size,
+    )
+    url = await server.start()
+    module = load_cog_module(url, args)
+
+    print(
+        f"{args.requests} requests of {args.queries} queries, "
+        f"{args.simple_ratio:.0%} simple, server latency {args.latency:.0f} ms, "
+        f"{'progressive' if args.progressive else 'not progressive'}"
+    )
+
+    async with aiohttp.ClientSession() as session:
+        for concurrency in args.concurrency:
+            result = await run_level(module, session, server, concurrency, args)
+
+            print(
+                f"\n{concurrency} concurrent members: "
+                f"{result['throughput']:.1f} requests/s, "
+                f"{result['errors']} errors"
+            )
+            print(
+                f"{'mode':<8}{'count':>7}{'first p50':>11}{'first p95':>11}"
+                f"{'done p50':>10}{'done p95':>10}{'done p99':>10}  (ms)"
+            )
+            for mode, (first, complete) in result["timings"].items():
+                if not complete:
+                    continue
+
+                print(
+                    f"{mode:<8}{len(complete):>7}"
+                    f"{percentile(first, 50) * 1000:>11.1f}"
+                    f"{percentile(first, 95) * 1000:>11.1f}"
+                    f"{percentile(complete, 50) * 1000:>10.1f}"
+                    f"{percentile(complete, 95) * 1000:>10.1f}"
+                    f"{percentile(complete, 99) * 1000:>10.1f}"
+                )
+
+            requests = result["requests"]
+            stats = result["stats"]
+            print(
+                f"Server requests: {requests['full']} full, "
+                f"{requests['first']} first pods, {requests['simple']} simple"
+            )
+            print(
+                f"Cache hits: {stats['memory_hits']} memory, "
+                f"{stats['db_hits']} DB, {stats['simple_hits']} images, "
+                f"{stats['misses']} misses, {stats['coalesced']} coalesced"
+            )
+            embed_times = result["embed_times"]
+            if embed_times:
+                print(
+                    f"Embeds: {len(embed_times)} built, "
+                    f"p50 {percentile(embed_times, 50) * 10**6:.0f} us, "
+                    f"p99 {percentile(embed_times, 99) * 10**6:.0f} us"
+                )
+
+    await server.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--concurrency", nargs="+", type=int,
+                        default=[1, 8, 32])
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--queries", type=int, default=20)
+    parser.add_argument("--simple-ratio", type=float, default=0.3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--progressive", action="store_true")
+    parser.add_argument("--latency", type=float, default=1000,
+                        help="milliseconds to answer a full query")
+    parser.add_argument("--first-pods-latency", type=float, default=300,
+                        help="milliseconds to answer the first pods")
+    parser.add_argument("--simple-latency", type=float, default=1000,
+                        help="milliseconds to answer a simple query")
+    parser.add_argument("--pods", type=int, default=6)
+    parser.add_argument("--image-size", type=int, default=50 * 2**10,
+                        help="bytes of the simple query images")
+
+    asyncio.run(main(parser.parse_args()))
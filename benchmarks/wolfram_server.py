@@ -0,0 +1,150 @@
+"""Stand-in for the Wolfram|Alpha API, serving made up results for any
+query after a fixed latency.
+`/v2/query` answers the full queries in XML, with `--pods` pods, or
+only the pods asked for with `podindex`. `/v1/simple` answers the simple
+queries with an image of `--image-size` bytes.
+The query `fail` fails, in both modes.
+Run it alone with `python -m benchmarks.wolfram_server`, and point the
+bot to it with `wolfram_api_url = "http://localhost:8000"` in config.py.
+"""
+import argparse
+import asyncio
+from collections import Counter
+from xml.sax.saxutils import escape, quoteattr
+
+from aiohttp import web
+
+
+# smallest GIF, padded to the wanted size
+GIF = (
+    b"GIF89a\x01\x00\x01\x00\x80\x00\x00\x00\x00\x00\xff\xff\xff!\xf9\x04"
+    b"\x01\x00\x00\x00\x00,\x00\x00\x00\x00\x01\x00\x01\x00\x00\x02\x02D"
+    b"\x01\x00;"
+)
+
+
+class WolframServer:
+    """aiohttp application answering like the Wolfram|Alpha API.
+    `latency` and `simple_latency` are in seconds, the first pods asked
+    for with `podindex` come back after `first_pods_latency`.
+    The requests received are counted in `requests`.
+    """
+
+    def __init__(self, latency=1.0, first_pods_latency=0.3,
+                 simple_latency=1.0, pods=6, image_size=50 * 2**10):
+        self.latency = latency
+        self.first_pods_latency = first_pods_latency
+        self.simple_latency = simple_latency
+        self.pods = pods
+        self.image_size = image_size
+
+        self.requests = Counter()
+
+        self.app = web.Application()
+        self.app.router.add_route("*", "/v2/query", self.query)
+        self.app.router.add_get("/v1/simple", self.simple)
+        self._runner = None
+
+    async def start(self, host="127.0.0.1", port=0):
+        """Start serving, and return the base URL of the server."""
+
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+
+        host, port = self._runner.addresses[0][:2]
+        return f"http://{host}:{port}"
+
+    async def close(self):
+        await self._runner.cleanup()
+
+    def make_pod(self, query, index):
+        titles = ("Input interpretation", "Result")
+        title = titles[index] if index < len(titles) else f"Property {index}"
+
+        plaintext = f"<plaintext>{escape(query)} {index}</plaintext>"
+        if index % 3 == 2:
+            # a plot, without text
+            plaintext = ""
+
+        return (
+            f"<pod title={quoteattr(title)} position='{index * 100}' "
+            f"numsubpods='1'><subpod title=''>"
+            f"<img src='http://localhost/image/{index}.gif' alt='' />"
+            f"{plaintext}</subpod></pod>"
+        )
+
+    async def query(self, request):
+        query = request.query.get("input", "")
+        podindex = request.query.get("podindex")
+        if podindex is not None:
+            self.requests["first"] += 1
+            indices = [int(i) - 1 for i in podindex.split(",")]
+            await asyncio.sleep(self.first_pods_latency)
+
+        else:
+            self.requests["full"] += 1
+            indices = range(self.pods)
+            await asyncio.sleep(self.latency)
+
+        if query == "fail":
+            body = "<queryresult success='false' error='false' numpods='0' />"
+
+        else:
+            pods = "".join(
+                self.make_pod(query, i) for i in indices if i < self.pods)
+            body = (
+                f"<queryresult success='true' error='false' "
+                f"numpods='{len(indices)}'>{pods}</queryresult>"
+            )
+
+        return web.Response(text=body, content_type="text/xml")
+
+    async def simple(self, request):
+        self.requests["simple"] += 1
+        await asyncio.sleep(self.simple_latency)
+
+        if request.query.get("i") == "fail":
+            return web.Response(status=501, text="Not implemented")
+
+        body = GIF + bytes(max(0, self.image_size - len(GIF)))
+        return web.Response(body=body, content_type="image/gif")
+
+
+async def main(args):
+    server = WolframServer(
+        latency=args.latency / 1000,
+        first_pods_latency=args.first_pods_latency / 1000,
+        simple_latency=args.simple_latency / 1000,
+        pods=args.pods,
+        image_size=args.image_size,
+    )
+    url = await server.start(args.host, args.port)
+    print(f"Serving on {url}")
+    try:
+        await asyncio.Event().wait()
+
+    finally:
+        await server.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=1000,
+                        help="milliseconds to answer a full query")
+    parser.add_argument("--first-pods-latency", type=float, default=300,
+                        help="milliseconds to answer the first pods")
+    parser.add_argument("--simple-latency", type=float, default=1000,
+                        help="milliseconds to answer a simple query")
+    parser.add_argument("--pods", type=int, default=6)
+    parser.add_argument("--image-size", type=int, default=50 * 2**10,
+                        help="bytes of the simple query images")
+
+    try:
+        asyncio.run(main(parser.parse_args()))
+
+    except KeyboardInterrupt:
+        pass
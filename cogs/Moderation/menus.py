@@ -2,6 +2,8 @@ import discord
 from discord.ext import menus
 from discord.ext.menus import MenuPages
 
+from .schema import from_epoch_ms
+
 
 class DeletedMessagesMenu(MenuPages):
     async def send_initial_message(self, ctx, channel):
@@ -46,9 +48,12 @@ class DeletedMessagesSource(menus.ListPageSource):
         for key in entries.keys():
             if key == "content":
                 continue
+            value = entries[key]
+            if key == "deleted_at":
+                value = discord.utils.format_dt(from_epoch_ms(value))
             embed.add_field(
                 name=key,
-                value=entries[key],
+                value=value,
             )
 
         return embed
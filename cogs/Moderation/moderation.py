@@ -1,5 +1,4 @@
 from collections import defaultdict
-from datetime import datetime
 import re
 from typing import Union
 
@@ -7,10 +6,18 @@ import discord
 from discord.ext import commands, tasks
 from discord.utils import parse_time
 
-from . import menus
+import config
+from . import menus, schema
+from .writer import LogWriter
 
 ADMIN_CHANNEL = 750166269860249671
 
+# the logged messages are inserted in batches, every LOG_BATCH_SIZE rows
+# or LOG_FLUSH_INTERVAL seconds, and the events wait past LOG_MAX_PENDING
+LOG_BATCH_SIZE = getattr(config, "moderation_log_batch_size", 100)
+LOG_FLUSH_INTERVAL = getattr(config, "moderation_log_flush_interval", 1.0)
+LOG_MAX_PENDING = getattr(config, "moderation_log_max_pending", 5000)
+
 
 def find_not_None(sequence, key):
     """Helper method to find the first entry that is not None in the
@@ -22,9 +29,19 @@ def find_not_None(sequence, key):
 class Moderation(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+        self.log_writer = LogWriter(
+            self.bot.db,
+            batch_size=LOG_BATCH_SIZE,
+            interval=LOG_FLUSH_INTERVAL,
+            max_pending=LOG_MAX_PENDING,
+        )
 
         self._create_tables.start()
 
+    async def cog_unload(self):
+        # also called when the bot closes
+        await self.log_writer.close()
+
     def cog_check(self, ctx):
         return commands.has_guild_permissions(administrator=True,).predicate(ctx)
 
@@ -73,17 +90,56 @@ class Moderation(commands.Cog):
             # ignore DM messages
             return
 
+        data = self._deleted_message_data(
+            payload.channel_id,
+            payload.guild_id,
+            payload.message_id,
+            schema.to_epoch_ms(discord.utils.utcnow()),
+            payload.cached_message,  # can be None
+        )
+
+        await self._log_deleted_message(data)
+
+    @commands.Cog.listener(name="on_raw_bulk_message_delete")
+    async def log_bulk_deleted_messages(self, payload):
+        """Save when messages are deleted at once, like with a purge, in
+        the database, in a single transaction.
+        """
+        if not payload.guild_id:
+            # ignore DM messages
+            return
+
+        deleted_at = schema.to_epoch_ms(discord.utils.utcnow())
+        cached_messages = {m.id: m for m in payload.cached_messages}
+        rows = [
+            self._deleted_message_data(
+                payload.channel_id,
+                payload.guild_id,
+                message_id,
+                deleted_at,
+                cached_messages.get(message_id),
+            )
+            for message_id in sorted(payload.message_ids)
+        ]
+
+        await self._log_deleted_messages(rows)
+
+    def _deleted_message_data(
+        self, channel_id, guild_id, message_id, deleted_at, cached_message
+    ):
+        """Return the row of a deleted message for the DB, with as much
+        information as possible.
+        """
         data = defaultdict(lambda: None)
         data.update(
             {
-                "channel_id": payload.channel_id,
-                "guild_id": payload.guild_id,
-                "message_id": payload.message_id,
-                "deleted_at": datetime.utcnow(),
+                "channel_id": channel_id,
+                "guild_id": guild_id,
+                "message_id": message_id,
+                "deleted_at": deleted_at,
             }
         )
 
-        cached_message = payload.cached_message  # can be None
         if cached_message:
             data.update(
                 {
@@ -93,7 +149,7 @@ class Moderation(commands.Cog):
                 }
             )
 
-        await self._log_deleted_message(data)
+        return data
 
     @commands.Cog.listener(name="on_raw_message_edit")
     async def log_edited_message(self, payload):
@@ -113,7 +169,7 @@ class Moderation(commands.Cog):
             {
                 "channel_id": payload.channel_id,
                 "message_id": payload.message_id,
-                "edited_at": edited_at,
+                "edited_at": schema.to_epoch_ms(edited_at),
                 "content_after": payload.data["content"],  # will always be present
                 "guild_id": payload.data.get("guild_id"),
             }
@@ -281,43 +337,23 @@ class Moderation(commands.Cog):
 
     @tasks.loop(count=1)
     async def _create_tables(self):
-        """Create the necessary tables, if they don't already exist."""
-
-        await self.bot.db.execute(
-            """
-            CREATE TABLE IF NOT EXISTS moderation_deletelog(
-                channel_id INTEGER   NOT NULL,
-                guild_id   INTEGER   NOT NULL,
-                message_id INTEGER   NOT NULL,
-                deleted_at TIMESTAMP NOT NULL,
-                content    TEXT,
-                user_id    INTEGER,
-                jump_url   TEXT
-            )
-            """
-        )
-
-        await self.bot.db.execute(
-            """
-            CREATE TABLE IF NOT EXISTS moderation_editlog(
-                channel_id     INTEGER   NOT NULL,
-                message_id     INTEGER   NOT NULL,
-                edited_at      TIMESTAMP NOT NULL,
-                guild_id       INTEGER,
-                content_before TEXT,
-                content_after  TEXT,
-                user_id        INTEGER,
-                jump_url       TEXT
-            )
-            """
-        )
-
-        await self.bot.db.commit()
+        """Create the necessary tables, or bring them to the latest
+        version.
+        """
+        # nothing is inserted while the tables change
+        async with self.log_writer.paused():
+            await schema.migrate(self.bot.db)
 
     async def _log_deleted_message(self, data):
-        """Save the deleted message to the DB."""
+        """Queue the deleted message to be saved to the DB."""
+
+        await self._log_deleted_messages([data])
 
-        await self.bot.db.execute(
+    async def _log_deleted_messages(self, rows):
+        """Queue the deleted messages to be saved to the DB, in the same
+        transaction.
+        """
+        await self.log_writer.put_many(
             """
             INSERT INTO moderation_deletelog
             VALUES (:channel_id,
@@ -328,15 +364,13 @@ class Moderation(commands.Cog):
                     :user_id,
                     :jump_url)
             """,
-            data,
+            rows,
         )
 
-        await self.bot.db.commit()
-
     async def _log_edited_message(self, data):
-        """Save the edited message to the DB."""
+        """Queue the edited message to be saved to the DB."""
 
-        await self.bot.db.execute(
+        await self.log_writer.put(
             """
             INSERT INTO moderation_editlog
             VALUES (:channel_id,
@@ -351,11 +385,10 @@ class Moderation(commands.Cog):
             data,
         )
 
-        await self.bot.db.commit()
-
     async def _get_deleted_messages_member(self, member, amount):
         """Get the `amount` latest deleted emssages of a member."""
 
+        await self.log_writer.flush()
         async with self.bot.db.execute(
             """
             SELECT *
@@ -373,6 +406,7 @@ class Moderation(commands.Cog):
     async def _get_deleted_messages_channel(self, channel, amount):
         """Get the `amount` latest deleted emssages of a member."""
 
+        await self.log_writer.flush()
         async with self.bot.db.execute(
             """
             SELECT *
@@ -390,6 +424,7 @@ class Moderation(commands.Cog):
     async def _get_edited_messages(self, message_id, channel_id):
         """Get the revisions of a message."""
 
+        await self.log_writer.flush()
         async with self.bot.db.execute(
             """
             SELECT *
@@ -0,0 +1,163 @@
+from datetime import datetime, timezone
+
+
+# SQL of a datetime stored as text by the previous versions, in epoch
+# milliseconds, leaving the times already converted alone
+TEXT_TO_EPOCH_MS = (
+    "CASE WHEN typeof({0}) = 'text' "
+    "THEN CAST(round((julianday({0}) - 2440587.5) * 86400000) AS INTEGER) "
+    "ELSE {0} END"
+)
+
+# the statements that bring the tables from a version to the next
+MIGRATIONS = {
+    1: [
+        """
+        CREATE TABLE IF NOT EXISTS moderation_deletelog(
+            channel_id INTEGER   NOT NULL,
+            guild_id   INTEGER   NOT NULL,
+            message_id INTEGER   NOT NULL,
+            deleted_at TIMESTAMP NOT NULL,
+            content    TEXT,
+            user_id    INTEGER,
+            jump_url   TEXT
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS moderation_editlog(
+            channel_id     INTEGER   NOT NULL,
+            message_id     INTEGER   NOT NULL,
+            edited_at      TIMESTAMP NOT NULL,
+            guild_id       INTEGER,
+            content_before TEXT,
+            content_after  TEXT,
+            user_id        INTEGER,
+            jump_url       TEXT
+        )
+        """,
+    ],
+    # times in epoch milliseconds, and indexes for the commands
+    2: [
+        """
+        CREATE TABLE moderation_deletelog_new(
+            channel_id INTEGER NOT NULL,
+            guild_id   INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            deleted_at INTEGER NOT NULL,
+            content    TEXT,
+            user_id    INTEGER,
+            jump_url   TEXT
+        )
+        """,
+        f"""
+        INSERT INTO moderation_deletelog_new
+        SELECT channel_id,
+               guild_id,
+               message_id,
+               {TEXT_TO_EPOCH_MS.format("deleted_at")},
+               content,
+               user_id,
+               jump_url
+          FROM moderation_deletelog
+        """,
+        "DROP TABLE moderation_deletelog",
+        "ALTER TABLE moderation_deletelog_new RENAME TO moderation_deletelog",
+        """
+        CREATE INDEX moderation_deletelog_user
+            ON moderation_deletelog(user_id, deleted_at)
+        """,
+        """
+        CREATE INDEX moderation_deletelog_channel
+            ON moderation_deletelog(channel_id, deleted_at)
+        """,
+        """
+        CREATE TABLE moderation_editlog_new(
+            channel_id     INTEGER NOT NULL,
+            message_id     INTEGER NOT NULL,
+            edited_at      INTEGER NOT NULL,
+            guild_id       INTEGER,
+            content_before TEXT,
+            content_after  TEXT,
+            user_id        INTEGER,
+            jump_url       TEXT
+        )
+        """,
+        f"""
+        INSERT INTO moderation_editlog_new
+        SELECT channel_id,
+               message_id,
+               {TEXT_TO_EPOCH_MS.format("edited_at")},
+               guild_id,
+               content_before,
+               content_after,
+               user_id,
+               jump_url
+          FROM moderation_editlog
+        """,
+        "DROP TABLE moderation_editlog",
+        "ALTER TABLE moderation_editlog_new RENAME TO moderation_editlog",
+        """
+        CREATE INDEX moderation_editlog_message
+            ON moderation_editlog(channel_id, message_id, edited_at)
+        """,
+    ],
+}
+
+LATEST_VERSION = max(MIGRATIONS)
+
+
+def to_epoch_ms(dt):
+    """Return the aware datetime in milliseconds since the epoch."""
+
+    return int(dt.timestamp() * 1000)
+
+
+def from_epoch_ms(ms):
+    """Return the aware datetime of the milliseconds since the epoch."""
+
+    return datetime.fromtimestamp(ms / 1000, timezone.utc)
+
+
+async def get_version(db):
+    """Return the version of the moderation tables, 0 if they were never
+    migrated.
+    """
+    await db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS moderation_version(
+            version INTEGER NOT NULL
+        )
+        """
+    )
+    async with db.execute("SELECT MAX(version) FROM moderation_version") as c:
+        row = await c.fetchone()
+
+    return row[0] or 0
+
+
+async def migrate(db, version=LATEST_VERSION):
+    """Bring the moderation tables to the version, one migration at a
+    time, each in its own transaction. Return the previous version.
+    """
+    previous = current = await get_version(db)
+    while current < version:
+        current += 1
+        # a savepoint works even if another cog has a transaction open
+        await db.execute("SAVEPOINT moderation_migration")
+        try:
+            for statement in MIGRATIONS[current]:
+                await db.execute(statement)
+            await db.execute(
+                "INSERT INTO moderation_version VALUES (:version)",
+                {"version": current},
+            )
+
+        except Exception:
+            await db.execute("ROLLBACK TO moderation_migration")
+            await db.execute("RELEASE moderation_migration")
+            raise
+
+        await db.execute("RELEASE moderation_migration")
+        await db.commit()
+
+    return previous
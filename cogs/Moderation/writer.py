@@ -0,0 +1,175 @@
+import asyncio
+import contextlib
+import sqlite3
+import traceback
+
+
+class LogWriter:
+    """Buffer the rows to insert in the logs, and insert them in a single
+    transaction, with one `executemany` per statement, every
+    `batch_size` rows or `interval` seconds.
+    Adding a row waits for a flush when `max_pending` rows are buffered,
+    so that a raid cannot fill the memory.
+    A row that cannot be inserted is dropped, without the others. The
+    rows of a flush that failed because of the database are put back in
+    the buffer, and dropped after `max_failures` failures in a row.
+    """
+
+    def __init__(self, db, batch_size=100, interval=1.0, max_pending=5000,
+                 max_failures=3):
+        self.db = db
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_pending = max_pending
+        self.max_failures = max_failures
+
+        self._rows = {}  # statement -> parameters of the rows
+        self._pending = 0
+        self._lock = asyncio.Lock()
+        self._full = asyncio.Event()
+        self._room = asyncio.Condition()
+        self._runner = None
+        self._failures = 0  # failed flushes in a row
+
+        self.stats = dict(rows=0, flushes=0, waits=0, errors=0, dropped=0)
+
+    async def put(self, statement, row):
+        """Buffer a row to insert with the statement."""
+
+        await self.put_many(statement, [row])
+
+    async def put_many(self, statement, rows):
+        """Buffer rows to insert with the statement, all in the same
+        transaction.
+        """
+        if self._pending >= self.max_pending:
+            self.stats["waits"] += 1
+            async with self._room:
+                await self._room.wait_for(
+                    lambda: self._pending < self.max_pending)
+
+        self._rows.setdefault(statement, []).extend(rows)
+        self._pending += len(rows)
+        if self._pending >= self.batch_size:
+            self._full.set()
+        self._schedule()
+
+    def _schedule(self):
+        if self._runner is None:
+            self._runner = asyncio.create_task(self._flush_soon())
+
+    async def _flush_soon(self):
+        try:
+            await asyncio.wait_for(self._full.wait(), self.interval)
+
+        except asyncio.TimeoutError:
+            pass
+
+        # the rows added from now on schedule another flush
+        self._runner = None
+        self._full.clear()
+        await self.flush()
+
+    async def flush(self):
+        """Insert the buffered rows, in a single transaction."""
+
+        async with self._lock:
+            rows, self._rows = self._rows, {}
+            count, self._pending = self._pending, 0
+            if not rows:
+                return
+
+            # the next rows are buffered while these are inserted
+            async with self._room:
+                self._room.notify_all()
+
+            # a savepoint only rolls back these rows, not the writes of
+            # the other cogs sharing the connection
+            await self.db.execute("SAVEPOINT log_writer")
+            try:
+                dropped = 0
+                for statement, parameters in rows.items():
+                    dropped += await self._insert(statement, parameters)
+
+            except Exception:
+                await self.db.execute("ROLLBACK TO log_writer")
+                await self.db.execute("RELEASE log_writer")
+                self.stats["errors"] += 1
+                traceback.print_exc()
+                self._retry(rows, count)
+                return
+
+            await self.db.execute("RELEASE log_writer")
+            await self.db.commit()
+            self._failures = 0
+            self.stats["rows"] += count - dropped
+            self.stats["flushes"] += 1
+            if dropped:
+                self.stats["errors"] += 1
+                self.stats["dropped"] += dropped
+
+    async def _insert(self, statement, parameters):
+        """Insert the rows with the statement, splitting them in halves
+        around the ones that fail, and return the number of rows that
+        could not be inserted. An error of the database rather than of
+        the rows is raised.
+        """
+        await self.db.execute("SAVEPOINT log_writer_rows")
+        try:
+            await self.db.executemany(statement, parameters)
+
+        except sqlite3.OperationalError:
+            await self.db.execute("ROLLBACK TO log_writer_rows")
+            await self.db.execute("RELEASE log_writer_rows")
+            raise
+
+        except Exception:
+            await self.db.execute("ROLLBACK TO log_writer_rows")
+            await self.db.execute("RELEASE log_writer_rows")
+            if len(parameters) == 1:
+                traceback.print_exc()
+                return 1
+
+            middle = len(parameters) // 2
+            return (
+                await self._insert(statement, parameters[:middle])
+                + await self._insert(statement, parameters[middle:])
+            )
+
+        await self.db.execute("RELEASE log_writer_rows")
+        return 0
+
+    def _retry(self, rows, count):
+        """Put the rows of a failed flush back before the new ones, or
+        drop them if the flushes keep failing.
+        """
+        self._failures += 1
+        if self._failures >= self.max_failures:
+            self._failures = 0
+            self.stats["dropped"] += count
+            return
+
+        for statement, parameters in self._rows.items():
+            rows.setdefault(statement, []).extend(parameters)
+        self._rows = rows
+        self._pending += count
+        self._schedule()
+
+    @contextlib.asynccontextmanager
+    async def paused(self):
+        """Hold the flushes, for example while the tables change."""
+
+        async with self._lock:
+            yield
+
+    async def close(self):
+        """Insert the buffered rows, after the flush in progress."""
+
+        runner = self._runner
+        if runner is not None:
+            self._full.set()
+            await runner
+        await self.flush()
+
+        # the rows of a failed last flush
+        self.stats["dropped"] += self._pending
@@ -0,0 +1,163 @@
+from collections import OrderedDict
+import hashlib
+import os
+
+
+def normalize_equation(equation):
+    """Return the equation with its insignificant whitespace collapsed,
+    so that `a + b` and ` a +  b ` share the same render.
+    """
+    return " ".join(equation.split())
+
+
+def render_key(equation, template):
+    """Return the content address of an equation rendered with the
+    given template.
+    """
+    digest = hashlib.sha256()
+    digest.update(template.encode())
+    digest.update(b"\0")
+    digest.update(normalize_equation(equation).encode())
+
+    return digest.hexdigest()
+
+
+class RenderCache:
+    """Two tier cache for rendered equations.
+    The memory tier is a LRU of the most recent images, the disk tier
+    keeps up to `disk_size` bytes of images in `path`, evicting the
+    least recently used ones first.
+    The keys of the last `failures_size` equations that could not be
+    rendered are remembered as well, so they are not compiled again.
+    """
+
+    def __init__(self, path, memory_size=128, disk_size=64 * 2**20,
+                 failures_size=256):
+        self.path = path
+        self.memory_size = memory_size
+        self.disk_size = disk_size
+        self.failures_size = failures_size
+
+        self._memory = OrderedDict()  # key -> bytes
+        self._disk = OrderedDict()  # key -> size in bytes
+        self._disk_bytes = 0
+        self._failures = OrderedDict()  # key -> None
+
+        self.stats = dict(
+            memory_hits=0, disk_hits=0, misses=0, evictions=0, failure_hits=0)
+
+        os.makedirs(self.path, exist_ok=True)
+        self._load_disk_index()
+
+    def _load_disk_index(self):
+        """Index the images already on disk, oldest first."""
+
+        entries = []
+        for entry in os.scandir(self.path):
+            if entry.name.endswith(".png"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name[:-4], stat.st_size))
+
+        for _, key, size in sorted(entries):
+            self._disk[key] = size
+            self._disk_bytes += size
+
+        self._evict_disk()
+
+    def _file_path(self, key):
+        return os.path.join(self.path, f"{key}.png")
+
+    def __contains__(self, key):
+        return key in self._memory or key in self._disk
+
+    def get(self, key):
+        """Return the image stored under `key`, or None."""
+
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            self.stats["memory_hits"] += 1
+            return self._memory[key]
+
+        if key in self._disk:
+            try:
+                with open(self._file_path(key), "rb") as f:
+                    data = f.read()
+
+            except FileNotFoundError:
+                # removed behind our back
+                self._disk_bytes -= self._disk.pop(key)
+
+            else:
+                self._disk.move_to_end(key)
+                self.stats["disk_hits"] += 1
+                self._remember(key, data)
+                return data
+
+        self.stats["misses"] += 1
+        return None
+
+    def put(self, key, data):
+        """Store the image `data` under `key` in both tiers."""
+
+        self._remember(key, data)
+
+        if key not in self._disk:
+            with open(self._file_path(key), "wb") as f:
+                f.write(data)
+
+            self._disk[key] = len(data)
+            self._disk_bytes += len(data)
+            self._evict_disk()
+
+    def has_failed(self, key):
+        """Return True if the equation under `key` could not be rendered."""
+
+        if key in self._failures:
+            self._failures.move_to_end(key)
+            self.stats["failure_hits"] += 1
+            return True
+
+        return False
+
+    def put_failure(self, key):
+        """Remember that the equation under `key` could not be rendered."""
+
+        self._failures[key] = None
+        self._failures.move_to_end(key)
+        while len(self._failures) > self.failures_size:
+            self._failures.popitem(last=False)
+
+    def _remember(self, key, data):
+        self._memory[key] = data
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    def _evict_disk(self):
+        while self._disk_bytes > self.disk_size and self._disk:
+            key, size = self._disk.popitem(last=False)
+            self._disk_bytes -= size
+            self.stats["evictions"] += 1
+            try:
+                os.remove(self._file_path(key))
+
+            except FileNotFoundError:
+                pass
+
+    @property
+    def hit_ratio(self):
+        hits = self.stats["memory_hits"] + self.stats["disk_hits"]
+        total = hits + self.stats["misses"]
+        return hits / total if total else 0.0
+
+    def info(self):
+        """Return a summary of the cache usage."""
+
+        return dict(
+            self.stats,
+            memory_entries=len(self._memory),
+            disk_entries=len(self._disk),
+            disk_bytes=self._disk_bytes,
+            failures=len(self._failures),
+            hit_ratio=self.hit_ratio,
+        )
@@ -0,0 +1,111 @@
+import heapq
+import json
+import os
+import time
+
+
+INDEX_FILE = ".expiry.json"
+
+
+class ExpiryIndex:
+    """Index of the files written in the folder `path`, to delete them
+    `expiration` seconds after their creation without scanning the folder.
+    The files are kept in a heap ordered by expiration time, saved in the
+    folder so it survives restarts. A file added again has its expiration
+    pushed back, and its previous entry in the heap is ignored.
+    Loading and saving block, and are meant to run in a thread.
+    """
+
+    def __init__(self, path, expiration):
+        self.path = path
+        self.expiration = expiration
+        self.index_path = os.path.join(path, INDEX_FILE)
+
+        self._heap = []  # (expires at, file name)
+        self._expires = {}  # file name -> latest expiration time
+        self.changed = False  # since the last save
+
+    def __len__(self):
+        return len(self._expires)
+
+    def add(self, paths, now=None):
+        """Track the files, to be deleted once expired."""
+
+        expires = (now or time.time()) + self.expiration
+        for path in paths:
+            name = os.path.relpath(path, self.path)
+            self._expires[name] = expires
+            heapq.heappush(self._heap, (expires, name))
+        self.changed = True
+
+    def pop_expired(self, limit, now=None):
+        """Return the paths of at most `limit` expired files, and forget
+        them.
+        """
+        now = now or time.time()
+        paths = []
+        while self._heap and self._heap[0][0] <= now and len(paths) < limit:
+            expires, name = heapq.heappop(self._heap)
+            if self._expires.get(name) != expires:
+                # added again since, or already removed
+                continue
+
+            del self._expires[name]
+            self.changed = True
+            paths.append(os.path.join(self.path, name))
+
+        return paths
+
+    def load(self):
+        """Return the entries of the saved index, with the files of the
+        folder that are not in it, expiring from their modification time.
+        This scans the folder, so it should only be done at startup.
+        """
+        try:
+            with open(self.index_path) as f:
+                entries = {name: expires for expires, name in json.load(f)}
+
+        except (FileNotFoundError, ValueError):
+            entries = {}
+
+        for entry in os.scandir(self.path):
+            if entry.name.startswith(INDEX_FILE) or entry.name in entries:
+                continue
+
+            entries[entry.name] = entry.stat().st_mtime + self.expiration
+
+        return [(expires, name) for name, expires in entries.items()]
+
+    def merge(self, entries):
+        """Track the loaded entries, unless their file was added since."""
+
+        for expires, name in entries:
+            if name not in self._expires:
+                self._expires[name] = expires
+                heapq.heappush(self._heap, (expires, name))
+
+    def entries(self):
+        """Return the entries to save."""
+
+        self.changed = False
+        return [(expires, name) for name, expires in self._expires.items()]
+
+    def save(self, entries):
+        """Save the entries of the index in the folder."""
+
+        temp_path = f"{self.index_path}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(entries, f)
+
+        os.replace(temp_path, self.index_path)
+
+
+def remove_files(paths):
+    """Remove the files, ignoring the ones already gone."""
+
+    for path in paths:
+        try:
+            os.remove(path)
+
+        except FileNotFoundError:
+            pass
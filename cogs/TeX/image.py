@@ -0,0 +1,179 @@
+import re
+import struct
+import zlib
+
+import numpy as np
+
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# bit depth of a palette PNG for a number of colors
+BIT_DEPTHS = {2: 1, 4: 2, 16: 4, 256: 8}
+
+
+def split_png_stream(data):
+    """Split the PNG images written one after the other in `data`, like
+    pdftoppm does on stdout for a document of many pages. A truncated
+    last image is dropped.
+    """
+    images = []
+    start = 0
+    while data.startswith(PNG_SIGNATURE, start):
+        position = start + len(PNG_SIGNATURE)
+        complete = False
+        while position + 8 <= len(data):
+            length, kind = struct.unpack_from(">I4s", data, position)
+            # length, type, data and CRC
+            position += 12 + length
+            if kind == b"IEND":
+                complete = position <= len(data)
+                break
+
+        if not complete:
+            break
+
+        images.append(data[start:position])
+        start = position
+
+    return images
+
+
+class ImageOptions:
+    """How the rasterized equations are post-processed.
+    With `optimize`, the image is cropped to the equation with `padding`
+    pixels around it, and saved as a palette PNG of `levels` gray levels.
+    With `transparent`, the background is transparent and the equation is
+    drawn in the `foreground` color instead of black.
+    """
+
+    def __init__(self, optimize=True, levels=16, padding=8,
+                 transparent=False, foreground=(0xdc, 0xdd, 0xde)):
+        if levels not in BIT_DEPTHS:
+            raise ValueError(f"levels must be one of {list(BIT_DEPTHS)}")
+
+        self.optimize = optimize
+        self.levels = levels
+        self.padding = padding
+        self.transparent = transparent
+        self.foreground = tuple(foreground)
+
+    def __str__(self):
+        if not self.optimize:
+            return "raw"
+
+        if self.transparent:
+            foreground = "".join(f"{c:02x}" for c in self.foreground)
+            background = f"transparent:{foreground}"
+
+        else:
+            background = "opaque"
+
+        return f"{self.levels}:{self.padding}:{background}"
+
+
+def parse_pgm_stream(data):
+    """Return the gray images, as arrays, of the binary PGM images written
+    one after the other in `data`, like pdftoppm -gray does on stdout.
+    """
+    images = []
+    position = 0
+    header = re.compile(rb"P5\s+(\d+)\s+(\d+)\s+(\d+)\s")
+    while match := header.match(data, position):
+        width, height, maxval = map(int, match.groups())
+        if maxval > 255:
+            raise ValueError("Only 8 bits PGM images are supported")
+
+        start = match.end()
+        end = start + width * height
+        if end > len(data):
+            # truncated
+            break
+
+        images.append(
+            np.frombuffer(data, np.uint8, width * height, start)
+            .reshape(height, width)
+        )
+        position = end
+
+    return images
+
+
+def crop(gray, padding):
+    """Crop the gray image to what is not white, with `padding` pixels of
+    white around it.
+    """
+    rows = np.flatnonzero((gray < 255).any(axis=1))
+    columns = np.flatnonzero((gray < 255).any(axis=0))
+    if rows.size == 0:
+        # blank image
+        return gray
+
+    cropped = gray[rows[0]:rows[-1] + 1, columns[0]:columns[-1] + 1]
+    return np.pad(cropped, padding, constant_values=255)
+
+
+def png_chunk(kind, data):
+    return (
+        struct.pack(">I", len(data))
+        + kind
+        + data
+        + struct.pack(">I", zlib.crc32(kind + data))
+    )
+
+
+def encode_palette_png(gray, options):
+    """Encode the gray image as a palette PNG of `options.levels` colors."""
+
+    levels = options.levels
+    depth = BIT_DEPTHS[levels]
+    height, width = gray.shape
+
+    # index 0 is black (the ink), index levels - 1 is white (the paper)
+    indices = np.rint(gray / 255 * (levels - 1)).astype(np.uint8)
+    values = np.rint(np.arange(levels) / (levels - 1) * 255).astype(np.uint8)
+
+    if options.transparent:
+        palette = np.tile(np.array(options.foreground, np.uint8), (levels, 1))
+        alpha = 255 - values
+
+    else:
+        palette = np.repeat(values[:, None], 3, axis=1)
+        alpha = None
+
+    # pack the indices in bytes, from the most significant bits
+    per_byte = 8 // depth
+    padded_width = -(-width // per_byte) * per_byte
+    packed = np.zeros((height, padded_width), np.uint8)
+    packed[:, :width] = indices
+    packed = packed.reshape(height, -1, per_byte)
+    shifts = np.arange(8 - depth, -1, -depth, dtype=np.uint8)
+    rows = np.bitwise_or.reduce(packed << shifts, axis=2).astype(np.uint8)
+
+    # filter type 0 (none) in front of every row
+    raw = np.hstack([np.zeros((height, 1), np.uint8), rows]).tobytes()
+
+    png = PNG_SIGNATURE
+    png += png_chunk(
+        b"IHDR", struct.pack(">IIBBBBB", width, height, depth, 3, 0, 0, 0))
+    png += png_chunk(b"PLTE", palette.tobytes())
+    if alpha is not None:
+        png += png_chunk(b"tRNS", alpha.tobytes())
+    png += png_chunk(b"IDAT", zlib.compress(raw, 9))
+    png += png_chunk(b"IEND", b"")
+
+    return png
+
+
+def optimize_image(gray, options):
+    """Crop the gray image and encode it as a small PNG."""
+
+    return encode_palette_png(crop(gray, options.padding), options)
+
+
+def optimize_images(grays, options):
+    """Optimize the gray images, None for the missing ones."""
+
+    return [
+        None if gray is None else optimize_image(gray, options)
+        for gray in grays
+    ]
@@ -0,0 +1,224 @@
+import asyncio
+import hashlib
+import itertools
+import os
+import shutil
+import tempfile
+import traceback
+
+from .process import ResourceLimits, RenderTimeout, kill
+
+
+def split_template(template):
+    """Split the LaTeX template into its preamble and its document body."""
+
+    index = template.index(r"\begin{document}")
+    return template[:index], template[index:]
+
+
+class WorkerPool:
+    """Pool of warm TeX processes.
+    The preamble of the template is dumped once in a format file, and
+    every worker is an `engine` process that already loaded that format
+    and waits on its terminal for the document body. A worker compiles a
+    single document, so it is replaced in the background as soon as it
+    is taken, and a worker that dies before getting a job is counted as
+    a crash and replaced as well.
+    With `scratch`, every worker writes in its own folder inside
+    `output_path`, to be removed once its document is read.
+    Workers run under `limits`, a job that takes too long kills its
+    worker and raises RenderTimeout.
+    """
+
+    # rebuild the format after this many crashes in a row, then give up
+    max_crashes = 3
+
+    # extension of the document written by each engine
+    extensions = {"pdflatex": ".pdf", "latex": ".dvi"}
+
+    def __init__(self, template, format_path, output_path, size=2,
+                 scratch=False, engine="pdflatex", limits=None):
+        self.preamble, self.body = split_template(template)
+        self.format_path = format_path
+        self.output_path = output_path
+        self.size = size
+        self.scratch = scratch
+        self.engine = engine
+        self.extension = self.extensions[engine]
+        self.limits = limits or ResourceLimits()
+
+        digest = hashlib.sha256(self.preamble.encode()).hexdigest()[:12]
+        self.format_name = f"physbot-{engine}-{digest}"
+
+        self.ready = False
+        self.stats = dict(
+            jobs=0, spawned=0, crashes=0, timeouts=0, format_builds=0)
+
+        self._idle = asyncio.Queue()
+        self._counter = itertools.count()
+        self._crashes = 0
+
+        os.makedirs(self.format_path, exist_ok=True)
+
+    async def start(self):
+        """Build the format file and spawn the workers."""
+
+        if self.size > 0 and await self.build_format():
+            # the wake up call of a previous close
+            while not self._idle.empty():
+                self._idle.get_nowait()
+            try:
+                for _ in range(self.size):
+                    await self._spawn()
+
+            except OSError:
+                traceback.print_exc()
+                self.close()
+                return
+
+            self.ready = True
+
+    def close(self):
+        """Kill the idle workers, and wake up the jobs waiting for one."""
+
+        self.ready = False
+        while not self._idle.empty():
+            document, process = self._idle.get_nowait()
+            if process is not None:
+                kill(process)
+                self.discard(document)
+
+        # passed on from one waiting job to the next
+        self._idle.put_nowait((None, None))
+
+    def discard(self, document):
+        """Remove the scratch folder of a worker."""
+
+        if self.scratch:
+            shutil.rmtree(os.path.dirname(document), ignore_errors=True)
+
+    async def build_format(self):
+        """Dump the preamble in a format file, return True on success."""
+
+        self.stats["format_builds"] += 1
+        source = os.path.join(self.format_path, f"{self.format_name}.tex")
+        with open(source, "w") as f:
+            f.write(self.preamble)
+            f.write("\n\\dump\n")
+
+        try:
+            process = await asyncio.create_subprocess_exec(
+                self.engine,
+                "-ini",
+                "-interaction=nonstopmode",
+                f"-jobname={self.format_name}",
+                "-output-directory",
+                self.format_path,
+                f"&{self.engine}",
+                source,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.DEVNULL,
+            )
+
+        except FileNotFoundError:
+            return False
+
+        await process.wait()
+        return os.path.exists(
+            os.path.join(self.format_path, f"{self.format_name}.fmt"))
+
+    async def _spawn(self):
+        jobname = f"worker_{next(self._counter)}"
+        if self.scratch:
+            workdir = tempfile.mkdtemp(dir=self.output_path)
+
+        else:
+            workdir = self.output_path
+            try:
+                # leftover from a previous run
+                os.remove(os.path.join(workdir, jobname + self.extension))
+
+            except FileNotFoundError:
+                pass
+
+        # scrollmode, so that the whole document is read from the terminal
+        process = await self.limits.create_process(
+            self.engine,
+            f"-fmt={os.path.join(self.format_path, self.format_name)}",
+            "-interaction=scrollmode",
+            "-file-line-error",
+            f"-jobname={jobname}",
+            "-output-directory",
+            workdir,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+        self.stats["spawned"] += 1
+        document = os.path.join(workdir, jobname + self.extension)
+        self._idle.put_nowait((document, process))
+
+    async def _respawn(self):
+        """Replace a worker, or close the pool if it cannot be done."""
+
+        try:
+            await self._spawn()
+
+        except OSError:
+            traceback.print_exc()
+            self.close()
+
+    async def _acquire(self):
+        """Return an idle worker that is still alive, replacing the ones
+        that crashed while waiting.
+        """
+        while self.ready:
+            document, process = await self._idle.get()
+            if process is None:
+                # the pool was closed while waiting
+                self._idle.put_nowait((None, None))
+                break
+
+            if process.returncode is None:
+                self._crashes = 0
+                await self._respawn()
+                return document, process
+
+            self.discard(document)
+            self.stats["crashes"] += 1
+            self._crashes += 1
+            if self._crashes < self.max_crashes:
+                await self._respawn()
+
+            elif self._crashes == self.max_crashes:
+                # the format is probably broken, rebuild it once
+                self.close()
+                await self.start()
+
+            else:
+                self.close()
+
+        return None, None
+
+    async def compile(self, body):
+        """Compile the document body and return the path to the compiled
+        document, or None if no worker is available.
+        """
+        document, process = await self._acquire()
+        if process is None:
+            return None
+
+        try:
+            await self.limits.communicate(process, body.encode())
+
+        except (BrokenPipeError, ConnectionResetError):
+            # died between the check and the job
+            self.stats["crashes"] += 1
+
+        except RenderTimeout:
+            self.stats["timeouts"] += 1
+            self.discard(document)
+            raise
+
+        self.stats["jobs"] += 1
+        return document
@@ -0,0 +1,105 @@
+import asyncio
+import os
+import shutil
+import signal
+
+
+# sets the limits of the command it executes, from util-linux; without it,
+# like on Windows, the processes are only limited in time
+PRLIMIT = shutil.which("prlimit")
+
+
+class RenderError(Exception):
+    """Error raised when a document could not be rendered."""
+
+
+class RenderTimeout(RenderError):
+    """Error raised when a process took longer than its time limit."""
+
+
+class ResourceLimits:
+    """Limits of the TeX processes, so that a pathological equation can
+    not hold a core or the memory for long.
+    `timeout` is the wall clock time of a job and `cpu_time` the CPU time
+    of a process, both in seconds, `memory` and `file_size` are in bytes.
+    """
+
+    def __init__(self, timeout=10, cpu_time=5, memory=512 * 2**20,
+                 file_size=16 * 2**20):
+        self.timeout = timeout
+        self.cpu_time = cpu_time
+        self.memory = memory
+        self.file_size = file_size
+
+    def command(self, *cmd):
+        """Return the command run through prlimit, so that the limits are
+        set without running Python in the forked child, which is unsafe
+        when the bot has threads.
+        """
+        if PRLIMIT is None:
+            return cmd
+
+        return (
+            PRLIMIT,
+            # the kernel sends SIGXCPU at the soft limit, SIGKILL at the hard one
+            f"--cpu={self.cpu_time}:{self.cpu_time + 1}",
+            f"--as={self.memory}",
+            f"--fsize={self.file_size}",
+            "--",
+            *cmd,
+        )
+
+    async def create_process(self, *cmd, **kwargs):
+        """Start the command with the limits, in its own process group."""
+
+        return await asyncio.create_subprocess_exec(
+            *self.command(*cmd),
+            start_new_session=True,
+            **kwargs,
+        )
+
+    async def communicate(self, process, input=None):
+        """Like process.communicate(input), but kill the process group
+        and raise RenderTimeout if it takes longer than the timeout.
+        """
+        try:
+            return await asyncio.wait_for(
+                process.communicate(input), self.timeout)
+
+        except asyncio.TimeoutError:
+            kill(process)
+            await process.wait()
+            raise RenderTimeout(
+                f"Process took more than {self.timeout} seconds") from None
+
+
+def kill(process):
+    """Kill the process and everything it started."""
+
+    if process.returncode is not None:
+        return
+
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+
+    except AttributeError:
+        # no process groups on Windows
+        process.kill()
+
+    except ProcessLookupError:
+        pass
+
+
+async def run_process(cmd, input=None, limits=None):
+    """Run the command, feeding it `input`, and return its stdout."""
+
+    limits = limits or ResourceLimits()
+    process = await limits.create_process(
+        *cmd,
+        stdin=asyncio.subprocess.PIPE if input is not None else None,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.DEVNULL,
+    )
+    stdout, _ = await limits.communicate(process, input)
+
+    return stdout
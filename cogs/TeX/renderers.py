@@ -0,0 +1,356 @@
+import asyncio
+from collections import defaultdict, deque
+import contextlib
+import os
+import shutil
+import tempfile
+import time
+
+from .image import (
+    ImageOptions,
+    optimize_images,
+    parse_pgm_stream,
+    split_png_stream,
+)
+from .pool import WorkerPool
+from .process import ResourceLimits, run_process
+
+
+class Renderer:
+    """Base class of the render backends.
+    A backend compiles the document with its TeX `engine`, then converts
+    each page of the compiled document to a PNG image.
+    Files are written in `temp_path` and kept around, unless a
+    `scratch_path` is given, in which case the document is read on stdin
+    and compiled in a scratch folder removed right after the render.
+    Every process runs under `limits`, and RenderTimeout is raised when
+    one of them takes too long.
+    The images are post-processed according to `image_options`.
+    The paths of the files written in `temp_path` are given to
+    `on_files`, if any, so they can be removed later.
+    The durations of the recent stages of the renders are kept in
+    `timings`.
+    """
+
+    name = None
+    engine = None
+
+    def __init__(self, template, temp_path, format_path, scratch_path=None,
+                 pool_size=2, dpi=150, limits=None, image_options=None,
+                 on_files=None):
+        self.template = template
+        self.temp_path = temp_path
+        self.scratch_path = scratch_path
+        self.dpi = dpi
+        self.limits = limits or ResourceLimits()
+        self.image_options = image_options or ImageOptions()
+        self.on_files = on_files
+        self.timings = defaultdict(lambda: deque(maxlen=1000))  # seconds
+
+        self.pool = WorkerPool(
+            template,
+            format_path,
+            scratch_path or temp_path,
+            size=pool_size,
+            scratch=self.diskless,
+            engine=self.engine,
+            limits=self.limits,
+        )
+        self.extension = self.pool.extension
+
+    @property
+    def diskless(self):
+        return self.scratch_path is not None
+
+    @property
+    def identity(self):
+        """What the images depend on, besides the document."""
+
+        return f"{self.name}:{self.dpi}:{self.image_options}"
+
+    async def start(self):
+        await self.pool.start()
+
+    @contextlib.contextmanager
+    def timed(self, stage):
+        """Record the duration of the block in the timings of `stage`."""
+
+        start = time.perf_counter()
+        try:
+            yield
+
+        finally:
+            self.timings[stage].append(time.perf_counter() - start)
+
+    def close(self):
+        self.pool.close()
+
+    def get_compile_cmd(self, source, workdir):
+        """Return the command to compile `source`, or the document read
+        on stdin if it is None.
+        """
+        cmd = [
+            self.engine,
+            '-file-line-error',
+            '-output-directory',
+            workdir,
+        ]
+        if source is None:
+            # scrollmode, so that the whole document is read from stdin
+            cmd += ['-interaction=scrollmode', '-jobname=document']
+
+        else:
+            cmd += ['-interaction=nonstopmode', source]
+
+        return cmd
+
+    async def render(self, pages, n_pages, tempfile):
+        """Compile the document made of `pages` and return the images of
+        its `n_pages` pages. The image of a missing page is None, and all
+        of them are None if the document has more pages than expected.
+        """
+        if self.diskless:
+            images = await self._render_diskless(pages, n_pages)
+
+        else:
+            images = await self._render_disk(pages, n_pages, tempfile)
+
+        if any(image is not None for image in images[n_pages:]):
+            # an equation added pages, the images after it are shifted
+            return [None] * n_pages
+
+        # an equation that broke the document can leave missing pages
+        images += [None] * (n_pages - len(images))
+        return images[:n_pages]
+
+    async def _render_disk(self, pages, n_pages, tempfile):
+        document = None
+        if self.pool.ready:
+            # the preamble is already loaded by the workers
+            with self.timed("compile"):
+                document = await self.pool.compile(
+                    self.pool.body.replace("%equations%", pages))
+
+        files = []
+        root = os.path.join(self.temp_path, tempfile)
+        try:
+            if document is None:
+                source = f"{root}.tex"
+                document = root + self.extension
+                files.append(source)
+                with self.timed("write"), open(source, 'w') as f:
+                    f.write(self.template.replace("%equations%", pages))
+
+                with self.timed("compile"):
+                    await run_process(
+                        self.get_compile_cmd(source, self.temp_path),
+                        limits=self.limits,
+                    )
+
+            paths = self.page_paths(root, n_pages)
+            files += paths
+            for path in paths:
+                # left by a previous render with the same name
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(path)
+
+            return await self.rasterize(document, root, n_pages)
+
+        finally:
+            self.track_files(files, document)
+
+    def track_files(self, files, document):
+        """Give the files written for the document to `on_files`."""
+
+        if self.on_files is not None and document is not None:
+            stem = os.path.splitext(document)[0]
+            self.on_files(files + [stem + ".aux", stem + ".log", document])
+
+    async def _render_diskless(self, pages, n_pages):
+        document = None
+        if self.pool.ready:
+            with self.timed("compile"):
+                document = await self.pool.compile(
+                    self.pool.body.replace("%equations%", pages))
+
+        if document is None:
+            workdir = tempfile.mkdtemp(dir=self.scratch_path)
+            document = os.path.join(workdir, "document" + self.extension)
+            # the first line read on the terminal has to be a command
+            source = "\\relax\n" + self.template.replace("%equations%", pages)
+            try:
+                with self.timed("compile"):
+                    await run_process(
+                        self.get_compile_cmd(None, workdir),
+                        source.encode(),
+                        limits=self.limits,
+                    )
+
+            except Exception:
+                shutil.rmtree(workdir, ignore_errors=True)
+                raise
+
+        workdir = os.path.dirname(document)
+        try:
+            return await self.rasterize(
+                document, os.path.join(workdir, "page"), n_pages)
+
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    async def rasterize(self, document, root, n_pages):
+        """Convert the compiled document to a list of PNG images, using
+        `root` for the name of the files if needed. The list goes at
+        least one page past `n_pages` if the document has more pages.
+        """
+        raise NotImplementedError
+
+    def page_paths(self, root, n_pages):
+        """Return the paths of the image files of the `n_pages` pages,
+        and of the page after them, to find out if the document has more.
+        """
+
+        raise NotImplementedError
+
+    def read_pages(self, paths):
+        """Return the content of the files, None for the missing ones."""
+
+        images = []
+        for path in paths:
+            try:
+                with open(path, 'rb') as f:
+                    images.append(f.read())
+
+            except FileNotFoundError:
+                images.append(None)
+
+        return images
+
+
+class PDFRenderer(Renderer):
+    """pdflatex to PDF, then pdftoppm to PNG.
+    When optimizing the images, pdftoppm writes gray PGM images instead,
+    which are cropped and encoded to PNG here.
+    """
+
+    name = "pdf"
+    engine = "pdflatex"
+
+    def get_convert_cmd(self, document, root=None):
+        """Return the command to convert the PDF to image files named
+        after `root`, or to stdout if it is None.
+        """
+        cmd = [  # pdf to png convert
+            'pdftoppm',
+            '-gray' if self.image_options.optimize else '-png',
+            '-r',
+            f'{self.dpi}',
+            document,
+        ]
+        if root is not None:
+            cmd.append(root)
+
+        return cmd
+
+    async def rasterize(self, document, root, n_pages):
+        if not os.path.exists(document):
+            return []
+
+        optimize = self.image_options.optimize
+        if self.diskless:
+            # every page is written to stdout, one after the other
+            with self.timed("convert"):
+                stream = await run_process(
+                    self.get_convert_cmd(document), limits=self.limits)
+            if optimize:
+                return await self.optimize(parse_pgm_stream(stream))
+
+            return split_png_stream(stream)
+
+        with self.timed("convert"):
+            await run_process(
+                self.get_convert_cmd(document, root), limits=self.limits)
+
+        with self.timed("read"):
+            pages = self.read_pages(self.page_paths(root, n_pages))
+        if optimize:
+            grays = [
+                (parse_pgm_stream(page) or [None])[0] if page else None
+                for page in pages
+            ]
+            return await self.optimize(grays)
+
+        return pages
+
+    def page_paths(self, root, n_pages):
+        # pdftoppm pads the page number to the width of the last one
+        digits = len(str(n_pages))
+        extension = "pgm" if self.image_options.optimize else "png"
+        return [
+            f"{root}-{page:0{digits}d}.{extension}"
+            for page in range(1, n_pages + 2)
+        ]
+
+    async def optimize(self, grays):
+        """Crop and encode the gray images, away from the event loop."""
+
+        with self.timed("optimize"):
+            return await asyncio.to_thread(
+                optimize_images, grays, self.image_options)
+
+
+class DVIRenderer(Renderer):
+    """latex to DVI, then dvipng to PNG cropped to the bounding box of
+    the equation.
+    dvipng does the optimization of the images itself, as a palette PNG
+    with the best compression. The number of gray levels and the padding
+    of the image options are not used.
+    """
+
+    name = "dvi"
+    engine = "latex"
+
+    def get_convert_cmd(self, document, root):
+        cmd = [  # dvi to png convert
+            'dvipng',
+            '-q',
+            '-T',
+            'tight',
+            '-D',
+            f'{self.dpi}',
+            '-o',
+            f'{root}-%d.png',
+        ]
+        options = self.image_options
+        if options.optimize:
+            cmd += ['-z', '9', '--palette']
+        if options.transparent:
+            red, green, blue = (c / 255 for c in options.foreground)
+            cmd += [
+                '-bg',
+                'Transparent',
+                '-fg',
+                f'rgb {red:.3f} {green:.3f} {blue:.3f}',
+            ]
+
+        cmd.append(document)
+        return cmd
+
+    async def rasterize(self, document, root, n_pages):
+        if not os.path.exists(document):
+            return []
+
+        with self.timed("convert"):
+            await run_process(
+                self.get_convert_cmd(document, root), limits=self.limits)
+
+        with self.timed("read"):
+            return self.read_pages(self.page_paths(root, n_pages))
+
+    def page_paths(self, root, n_pages):
+        return [f"{root}-{page}.png" for page in range(1, n_pages + 2)]
+
+
+RENDERERS = {
+    renderer.name: renderer for renderer in (PDFRenderer, DVIRenderer)
+}
@@ -0,0 +1,205 @@
+import asyncio
+from collections import OrderedDict, deque
+import time
+
+
+class QueueFull(Exception):
+    """Error raised when a job can not be queued."""
+
+
+class _Job:
+    def __init__(self, keys, factory, future, background=False):
+        self.keys = keys
+        self.factory = factory
+        self.future = future
+        self.background = background
+        self.queued_at = time.perf_counter()
+
+
+class RenderScheduler:
+    """Bounded queue in front of the renderer.
+    At most `concurrency` jobs run at the same time. Queued jobs are
+    served round-robin between channels, then between the members of a
+    channel, so that one busy channel or member does not starve the
+    others. A job renders several keys at once, but a key already queued
+    or running is not run again, its caller waits for the same result
+    instead. The queue limits count keys.
+    Background jobs only run when no other job is queued, one at a time,
+    so they never hold all the slots. A background job that did not start
+    yet moves to the queue of the first member that waits for one of its
+    keys.
+    """
+
+    def __init__(self, concurrency=2, max_queued=100, max_queued_owner=10):
+        self.concurrency = concurrency
+        self.max_queued = max_queued
+        self.max_queued_owner = max_queued_owner
+
+        self._queues = OrderedDict()  # channel -> user -> deque of jobs
+        self._background = deque()
+        self._background_running = False
+        self._inflight = {}  # key -> (job, index in its keys)
+        self._queued = 0
+        self._running = 0
+
+        self.waits = deque(maxlen=1000)  # seconds spent in the queue
+        self.stats = dict(
+            submitted=0, coalesced=0, rejected=0, completed=0, max_depth=0,
+            background=0, promoted=0)
+
+    @property
+    def depth(self):
+        return self._queued
+
+    @property
+    def running(self):
+        return self._running
+
+    async def submit(self, keys, channel_id, user_id, factory):
+        """Run the coroutine returned by `factory(new_keys)` when a slot is
+        free, where `new_keys` are the keys not already queued or running,
+        and return the results of all the keys, in order.
+        Raise QueueFull if the queue or the member's share of it is full.
+        """
+        self.stats["submitted"] += 1
+
+        new_keys = self._new_keys(keys)
+        if new_keys:
+            users = self._queues.get(channel_id, {})
+            owner_queued = sum(len(j.keys) for j in users.get(user_id, ()))
+            if (self._queued + len(new_keys) > self.max_queued
+                    or owner_queued + len(new_keys) > self.max_queued_owner):
+                self.stats["rejected"] += 1
+                raise QueueFull(
+                    "Too many equations are waiting to be rendered.")
+
+            self._enqueue(
+                self._make_job(new_keys, factory), channel_id, user_id)
+
+        self._promote(keys, channel_id, user_id)
+        self._dispatch()
+        return await self._results(keys)
+
+    async def submit_background(self, keys, factory):
+        """Like submit, for a job that only runs when the queue is empty.
+        Background jobs are not limited in number, the caller is expected
+        to wait for one before submitting the next.
+        """
+        new_keys = self._new_keys(keys)
+        if new_keys:
+            job = self._make_job(new_keys, factory, background=True)
+            self._background.append(job)
+            self._dispatch()
+
+        return await self._results(keys)
+
+    def _enqueue(self, job, channel_id, user_id):
+        self._queues.setdefault(channel_id, OrderedDict()).setdefault(
+            user_id, deque()).append(job)
+        self._queued += len(job.keys)
+        self.stats["max_depth"] = max(self.stats["max_depth"], self._queued)
+
+    def _promote(self, keys, channel_id, user_id):
+        """Move the background jobs of the keys that did not start yet to
+        the member's queue, so that the member does not wait for the
+        queue to be empty.
+        """
+        for key in keys:
+            job, _ = self._inflight[key]
+            if job.background and job in self._background:
+                self._background.remove(job)
+                job.background = False
+                job.queued_at = time.perf_counter()
+                self._enqueue(job, channel_id, user_id)
+                self.stats["promoted"] += 1
+
+    def _new_keys(self, keys):
+        """Return the keys that are not queued or running, once each,
+        and count the others as coalesced.
+        """
+        new_keys = [k for k in dict.fromkeys(keys) if k not in self._inflight]
+        self.stats["coalesced"] += len(set(keys)) - len(new_keys)
+        return new_keys
+
+    def _make_job(self, keys, factory, background=False):
+        future = asyncio.get_running_loop().create_future()
+        job = _Job(keys, factory, future, background=background)
+        for i, key in enumerate(keys):
+            self._inflight[key] = (job, i)
+        return job
+
+    async def _results(self, keys):
+        """Wait for the jobs of the keys, and return their results."""
+
+        # before waiting, the jobs of the other keys could finish
+        jobs = [self._inflight[key] for key in keys]
+        return [(await asyncio.shield(job.future))[i] for job, i in jobs]
+
+    def _next_job(self):
+        """Pop the next job, round-robin between channels then users."""
+
+        channel_id, users = next(iter(self._queues.items()))
+        user_id, jobs = next(iter(users.items()))
+        job = jobs.popleft()
+        self._queued -= len(job.keys)
+
+        if jobs:
+            users.move_to_end(user_id)
+        else:
+            del users[user_id]
+
+        if users:
+            self._queues.move_to_end(channel_id)
+        else:
+            del self._queues[channel_id]
+
+        return job
+
+    def _dispatch(self):
+        while self._queued and self._running < self.concurrency:
+            job = self._next_job()
+            self._running += 1
+            self.waits.append(time.perf_counter() - job.queued_at)
+            asyncio.create_task(self._run(job))
+
+        if (self._background and not self._queued
+                and not self._background_running
+                and self._running < self.concurrency):
+            self._background_running = True
+            self._running += 1
+            asyncio.create_task(self._run(self._background.popleft()))
+
+    async def _run(self, job):
+        try:
+            result = await job.factory(job.keys)
+
+        except Exception as e:
+            job.future.set_exception(e)
+
+        else:
+            job.future.set_result(result)
+
+        finally:
+            if not job.future.done():
+                # cancelled
+                job.future.cancel()
+            for key in job.keys:
+                del self._inflight[key]
+            self._running -= 1
+            if job.background:
+                self._background_running = False
+                self.stats["background"] += 1
+            else:
+                self.stats["completed"] += 1
+            self._dispatch()
+
+    def wait_percentile(self, percentile):
+        """Return the given percentile of the recent queue waits, in
+        seconds.
+        """
+        if not self.waits:
+            return 0.0
+
+        waits = sorted(self.waits)
+        index = min(len(waits) - 1, int(percentile / 100 * len(waits)))
+        return waits[index]
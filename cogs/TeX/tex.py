@@ -1,12 +1,24 @@
+from collections import Counter, OrderedDict
 import asyncio
+from datetime import datetime
+import functools
+import io
 import os
 import re
-import time
+import tempfile
 
 import discord
 from discord.ext import commands
 from discord.ext import tasks
 
+import config
+from .cache import RenderCache, normalize_equation, render_key
+from .expiry import ExpiryIndex, remove_files
+from .image import ImageOptions
+from .process import RenderError, ResourceLimits
+from .renderers import RENDERERS
+from .scheduler import QueueFull, RenderScheduler
+
 
 DIR_PATH = os.path.dirname(__file__)
 
@@ -14,32 +26,88 @@ DIR_PATH = os.path.dirname(__file__)
 with open(os.path.join(DIR_PATH, "struct.tex"), 'r') as f:
     LATEX_FILE = "".join(f.readlines())
 
+with open(os.path.join(DIR_PATH, "equation.tex"), 'r') as f:
+    LATEX_EQUATION = "".join(f.readlines())
+
+# what the image of an equation depends on, besides the equation itself
+LATEX_TEMPLATE = LATEX_FILE + LATEX_EQUATION
+
+# Discord's limit of attachments per message
+MAX_FILES = 10
+
+# number of messages whose replies are edited along with them
+TRACKED_MESSAGES = 500
+
+# seconds before a temporary file is removed, and files removed at once
+TEMP_EXPIRATION = 24 * 3600
+TEMP_BATCH_SIZE = 200
+
 
 LATEX_TEMP_PATH = os.path.join(DIR_PATH, "temp/")
 os.makedirs(LATEX_TEMP_PATH, exist_ok=True)
 
+LATEX_CACHE_PATH = os.path.join(DIR_PATH, "cache/")
+LATEX_FORMAT_PATH = os.path.join(DIR_PATH, "format/")
+
+# number of images kept in memory, and bytes of images kept on disk
+CACHE_MEMORY_SIZE = getattr(config, "tex_cache_memory_size", 128)
+CACHE_DISK_SIZE = getattr(config, "tex_cache_disk_size", 64 * 2**20)
+# render backend, "pdf" (pdflatex and pdftoppm) or "dvi" (latex and dvipng)
+RENDERER = getattr(config, "tex_renderer", "pdf")
+# resolution of the images
+RENDER_DPI = getattr(config, "tex_dpi", 150)
+# crop the images and save them with fewer colors, and optionally draw the
+# equations in the foreground color on a transparent background
+OPTIMIZE_IMAGES = getattr(config, "tex_optimize_images", True)
+IMAGE_COLORS = getattr(config, "tex_colors", 16)
+IMAGE_PADDING = getattr(config, "tex_padding", 8)
+TRANSPARENT = getattr(config, "tex_transparent", False)
+FOREGROUND = getattr(config, "tex_foreground", "dcddde")
+# limits of each TeX process: wall clock and CPU time in seconds, memory and
+# written file size in bytes
+RENDER_TIMEOUT = getattr(config, "tex_timeout", 10)
+RENDER_CPU_TIME = getattr(config, "tex_cpu_time", 5)
+RENDER_MEMORY = getattr(config, "tex_memory", 512 * 2**20)
+RENDER_FILE_SIZE = getattr(config, "tex_file_size", 16 * 2**20)
+# number of warm TeX workers, 0 to compile the whole template each time
+WORKER_POOL_SIZE = getattr(config, "tex_worker_pool_size", 2)
+# renders running at the same time, and equations allowed to wait in total
+# and per member
+RENDER_CONCURRENCY = getattr(config, "tex_render_concurrency", 2)
+RENDER_QUEUE_SIZE = getattr(config, "tex_render_queue_size", 100)
+RENDER_QUEUE_SIZE_MEMBER = getattr(config, "tex_render_queue_size_member", 10)
+# number of the most requested equations rendered in the background at
+# startup, if they are not in the cache
+PREWARM_COUNT = getattr(config, "tex_prewarm_count", 50)
+# compile in a scratch folder removed after each render, in memory if possible
+DISKLESS = getattr(config, "tex_diskless", False)
+SCRATCH_PATH = getattr(
+    config,
+    "tex_scratch_path",
+    "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(),
+)
+
+
+def find_equations(content):
+    """Return the equation blocks of the message content."""
+
+    return re.findall(r'\`\$.*?(?<!\\\\)\$\`', content)
+
+
+# what can change the pages after an equation, in a document shared with
+# other equations: global definitions and counters, commands built from
+# their name, and environments that can end the page of the equation
+RENDER_ALONE = re.compile(
+    r"\\(global|gdef|xdef|def|csname|setcounter|addtocounter|stepcounter"
+    r"|newcounter)|preview|\\begin\{|\\end\{"
+)
 
-def get_latex_cmds(tempfile):
-    cmds = [
-        [  # pdflatex compilation in temporary folder
-            # 'pdftex',
-            'pdflatex',
-            '-synctex=1',
-            '-interaction=nonstopmode',
-            '-file-line-error',
-            '-output-directory',
-            LATEX_TEMP_PATH,
-            f'{LATEX_TEMP_PATH}{tempfile}.tex',
-        ],
-        [  # pdf to png convert
-            'pdftoppm',
-            '-png',
-            f'{LATEX_TEMP_PATH}{tempfile}.pdf',
-            f'{LATEX_TEMP_PATH}{tempfile}',
-        ],
-    ]
 
-    return cmds
+def strip_equation(match):
+    """Return the equation of an equation block, without its backticks,
+    dollar signs and surrounding whitespace.
+    """
+    return match.strip("`").strip("$").strip()
 
 
 class TeX(commands.Cog):
@@ -48,10 +116,65 @@ class TeX(commands.Cog):
     the resulting equation back.
     """
     def __init__(self, bot):
-        self.clean_temp_folder.start(expiration=24 * 3600)
+        self.bot = bot
+        self.temp_files = ExpiryIndex(LATEX_TEMP_PATH, TEMP_EXPIRATION)
+        self.cache = RenderCache(
+            LATEX_CACHE_PATH,
+            memory_size=CACHE_MEMORY_SIZE,
+            disk_size=CACHE_DISK_SIZE,
+        )
+        self.renderer = RENDERERS[RENDERER](
+            LATEX_FILE,
+            LATEX_TEMP_PATH,
+            LATEX_FORMAT_PATH,
+            scratch_path=SCRATCH_PATH if DISKLESS else None,
+            pool_size=WORKER_POOL_SIZE,
+            dpi=RENDER_DPI,
+            limits=ResourceLimits(
+                timeout=RENDER_TIMEOUT,
+                cpu_time=RENDER_CPU_TIME,
+                memory=RENDER_MEMORY,
+                file_size=RENDER_FILE_SIZE,
+            ),
+            image_options=ImageOptions(
+                optimize=OPTIMIZE_IMAGES,
+                levels=IMAGE_COLORS,
+                padding=IMAGE_PADDING,
+                transparent=TRANSPARENT,
+                foreground=bytes.fromhex(FOREGROUND),
+            ),
+            on_files=self.temp_files.add,
+        )
+        self.scheduler = RenderScheduler(
+            concurrency=RENDER_CONCURRENCY,
+            max_queued=RENDER_QUEUE_SIZE,
+            max_queued_owner=RENDER_QUEUE_SIZE_MEMBER,
+        )
+        self.replies = OrderedDict()  # message id -> (keys, replies)
+        # message id -> latest edited content, for the messages whose
+        # replies are being sent, None if not edited in the meantime
+        self.rendering = {}
+        self.requests = Counter()  # equation -> requests not saved yet
+        self._start_pool.start()
+        self._create_tables.start()
+        self._save_requests.start()
+        self._prewarm.start()
+        if not DISKLESS:
+            self.clean_temp_folder.start()
 
-    def cog_unload(self):
-        self.clean_temp_folder.cancel()
+    async def cog_unload(self):
+        self._start_pool.cancel()
+        self._create_tables.cancel()
+        self._save_requests.cancel()
+        self._prewarm.cancel()
+        self.renderer.close()
+        if self.clean_temp_folder.is_running():
+            self.clean_temp_folder.cancel()
+            self.temp_files.save(self.temp_files.entries())
+
+        # the requests since the last save, so that the next startup
+        # prewarms the equations requested just before a reload
+        await self._save_requests()
 
     @commands.Cog.listener()
     async def on_message(self, message):
@@ -60,33 +183,458 @@ class TeX(commands.Cog):
         if message.author.bot:
             return
 
-        matches = re.findall(r'\`\$.*?(?<!\\\\)\$\`', message.content)
+        matches = find_equations(message.content)
+        if not matches:
+            return
+
+        equations = [strip_equation(match) for match in matches]
+        self.requests.update(normalize_equation(e) for e in equations)
+        keys = [self.get_key(equation) for equation in equations]
+        # an edit from now on waits for the replies, not to send its own
+        self.rendering[message.id] = None
+        try:
+            try:
+                images = await self.get_images(
+                    matches,
+                    keys,
+                    f"{message.id}",
+                    message.channel.id,
+                    message.author.id,
+                )
+
+            except QueueFull as e:
+                await message.reply(content=str(e))
+                return
+
+            replies = []
+            chunks = self.format_replies(matches, images, message.id)
+            for content, files in chunks:
+                replies.append(
+                    await message.reply(content=content, files=files))
+
+            self.track_replies(message.id, keys, replies)
+            await self.apply_edits(
+                message.id, message.channel.id, message.author.id)
+
+        finally:
+            del self.rendering[message.id]
+
+    @commands.Cog.listener()
+    async def on_raw_message_edit(self, payload):
+        """Render the equations of an edited message again, and edit the
+        replies in place. Only the equations that changed are compiled.
+        """
+        content = payload.data.get("content")
+        author = payload.data.get("author", {})
+        if content is None or author.get("bot"):
+            return
+
+        cached_message = payload.cached_message
+        if (payload.data.get("edited_timestamp") is None
+                or (cached_message is not None
+                    and cached_message.content == content)):
+            # not a content edit, like an embed or a pin, that also
+            # sends the content
+            return
+
+        if payload.message_id in self.rendering:
+            # edit the replies once they are sent
+            self.rendering[payload.message_id] = content
+            return
+
+        author_id = int(author.get("id", 0))
+        self.rendering[payload.message_id] = None
+        try:
+            await self.edit_replies(
+                payload.message_id, payload.channel_id, author_id, content)
+            await self.apply_edits(
+                payload.message_id, payload.channel_id, author_id)
+
+        finally:
+            del self.rendering[payload.message_id]
+
+    async def apply_edits(self, message_id, channel_id, author_id):
+        """Edit the replies to the latest content of the message, if it
+        was edited while they were being sent.
+        """
+        while (content := self.rendering[message_id]) is not None:
+            self.rendering[message_id] = None
+            await self.edit_replies(message_id, channel_id, author_id, content)
+
+    async def edit_replies(self, message_id, channel_id, author_id, content):
+        """Edit, send or delete the replies to a message for its new
+        content.
+        """
+        old_keys, old_replies = self.replies.pop(message_id, ((), []))
+        matches = find_equations(content)
+        if not matches and not old_replies:
+            return
+
+        keys = [self.get_key(strip_equation(match)) for match in matches]
+        if keys == list(old_keys):
+            # the equations did not change
+            self.track_replies(message_id, keys, old_replies)
+            return
+
+        if not matches:
+            for reply in old_replies:
+                try:
+                    await reply.delete()
+
+                except discord.NotFound:
+                    pass
+            return
+
+        try:
+            # the unchanged equations are found in the cache
+            images = await self.get_images(
+                matches,
+                keys,
+                f"{message_id}_edited",
+                channel_id,
+                author_id,
+            )
+
+        except QueueFull:
+            self.track_replies(message_id, old_keys, old_replies)
+            return
+
+        message = self.bot.get_partial_messageable(
+            channel_id).get_partial_message(message_id)
+        chunks = self.format_replies(matches, images, message_id)
+
+        replies = []
+        for i, (content, files) in enumerate(chunks):
+            reply = None
+            if i < len(old_replies):
+                try:
+                    reply = await old_replies[i].edit(
+                        content=content, attachments=files)
+
+                except discord.NotFound:
+                    # the reply was deleted
+                    pass
+
+            if reply is None:
+                reply = await message.reply(content=content, files=files)
+
+            replies.append(reply)
+
+        for reply in old_replies[len(chunks):]:
+            try:
+                await reply.delete()
 
-        for i, match in enumerate(matches):
-            tempfile = f'{message.id}_{i}'
-            match_strip = match.strip("$").strip("`")
+            except discord.NotFound:
+                pass
 
-            with open(f'{LATEX_TEMP_PATH}{tempfile}.tex', 'w') as f:
-                f.write(LATEX_FILE.replace("%equation%", match_strip))
+        self.track_replies(message_id, keys, replies)
 
-            for cmd in get_latex_cmds(tempfile):
-                process = await asyncio.create_subprocess_exec(
-                    *cmd,
-                    stdout=asyncio.subprocess.PIPE,
-                    stderr=asyncio.subprocess.PIPE,
+    @commands.group(invoke_without_command=True)
+    @commands.is_owner()
+    async def tex(self, ctx):
+        """Commands to inspect the TeX renderer."""
+
+        await ctx.send_help(ctx.command)
+
+    @tex.command(name="stats")
+    async def tex_stats(self, ctx):
+        """Show the render cache, queue and workers counters."""
+
+        info = self.cache.info()
+        pool = self.renderer.pool
+        embed = discord.Embed(
+            title="TeX render cache",
+            color=discord.Color.blurple(),
+        ).add_field(
+            name="Hits",
+            value=(
+                f"Memory: {info['memory_hits']}\n"
+                f"Disk: {info['disk_hits']}\n"
+                f"Failed: {info['failure_hits']}\n"
+                f"Ratio: {info['hit_ratio']:.1%}"
+            ),
+        ).add_field(
+            name="Misses",
+            value=f"{info['misses']}",
+        ).add_field(
+            name="Usage",
+            value=(
+                f"Memory: {info['memory_entries']} / {self.cache.memory_size}\n"
+                f"Disk: {info['disk_entries']} images, "
+                f"{info['disk_bytes'] / 2**20:.1f} / "
+                f"{self.cache.disk_size / 2**20:.1f} MiB\n"
+                f"Evictions: {info['evictions']}"
+            ),
+            inline=False,
+        ).add_field(
+            name="Queue",
+            value=(
+                f"Depth: {self.scheduler.depth} "
+                f"(max {self.scheduler.stats['max_depth']})\n"
+                f"Running: {self.scheduler.running} / "
+                f"{self.scheduler.concurrency}\n"
+                f"Wait p50: {self.scheduler.wait_percentile(50) * 1000:.0f} ms, "
+                f"p95: {self.scheduler.wait_percentile(95) * 1000:.0f} ms\n"
+                f"Coalesced: {self.scheduler.stats['coalesced']}, "
+                f"rejected: {self.scheduler.stats['rejected']}\n"
+                f"Prewarmed: {self.scheduler.stats['background']}"
+            ),
+            inline=False,
+        ).add_field(
+            name="Workers",
+            value=(
+                f"Renderer: {self.renderer.identity}\n"
+                f"Ready: {pool.ready} ({pool.size} workers)\n"
+                f"Jobs: {pool.stats['jobs']}\n"
+                f"Crashes: {pool.stats['crashes']}, "
+                f"timeouts: {pool.stats['timeouts']}"
+            ),
+            inline=False,
+        )
+
+        await ctx.reply(embed=embed)
+
+    def get_key(self, equation):
+        """Return the cache key of the equation."""
+
+        return render_key(equation, LATEX_TEMPLATE + self.renderer.identity)
+
+    async def get_images(self, matches, keys, tempfile, channel_id, user_id):
+        """Return the images of the equations, from the cache if possible,
+        otherwise compiling the missing ones in a single document, apart
+        from the ones that could change the pages of the others.
+        The equations already being rendered are not compiled again.
+        The image of an equation that could not be rendered is None.
+        """
+        images = [None] * len(keys)
+        missing = []
+        for i, key in enumerate(keys):
+            if self.cache.has_failed(key):
+                # already tried, no need to compile it again
+                continue
+
+            images[i] = self.cache.get(key)
+            if images[i] is None:
+                missing.append(i)
+
+        if missing:
+            equations = {keys[i]: strip_equation(matches[i]) for i in missing}
+            rendered = await self.scheduler.submit(
+                list(equations),
+                channel_id,
+                user_id,
+                functools.partial(self.render_keys, equations, tempfile),
+            )
+
+            rendered = dict(zip(equations, rendered))
+            for i in missing:
+                images[i] = rendered[keys[i]]
+
+        return images
+
+    def format_replies(self, matches, images, message_id):
+        """Return the content and files of the replies, split to respect
+        the limit of attachments per message.
+        """
+        replies = list(zip(matches, images))
+        chunks = []
+        for start in range(0, len(replies), MAX_FILES):
+            chunk = replies[start:start + MAX_FILES]
+            content = "\n".join(
+                f"> {match.strip('$')}"
+                + (" (render failed)" if image is None else "")
+                for match, image in chunk
+            )
+            files = [
+                discord.File(
+                    io.BytesIO(image),
+                    filename=f"{message_id}_{start + i}.png",
                 )
-                await process.wait()
+                for i, (_, image) in enumerate(chunk)
+                if image is not None
+            ]
+            chunks.append((content[:2000], files))
+
+        return chunks
 
-            content = f"> {match.strip('$')}"
-            file = discord.File(f"{LATEX_TEMP_PATH}{tempfile}-1.png")
-            await message.reply(content=content, file=file)
+    def track_replies(self, message_id, keys, replies):
+        """Remember the replies to a message, to edit them if the message
+        is edited. Only the latest messages are remembered.
+        """
+        self.replies[message_id] = (keys, replies)
+        self.replies.move_to_end(message_id)
+        while len(self.replies) > TRACKED_MESSAGES:
+            self.replies.popitem(last=False)
 
-    @tasks.loop(hours=1)
-    async def clean_temp_folder(self, expiration):
-        """Clean temporary files if they are older than 'expiration'
-        seconds.
+    async def render_keys(self, equations, tempfile, keys):
+        """Render the equations of the keys, from the mapping of keys to
+        equations, and cache them.
         """
-        for file in os.listdir(LATEX_TEMP_PATH):
-            file_path = os.path.join(LATEX_TEMP_PATH, file)
-            if (time.time() - os.path.getmtime(file_path)) > expiration:
-                os.remove(file_path)
+        return await self.render_and_cache(
+            keys, [equations[key] for key in keys], tempfile)
+
+    async def render_and_cache(self, keys, equations, tempfile):
+        """Render the equations and save the images in the cache, or
+        remember the ones that failed. The equations that could change
+        the pages of the others are rendered alone.
+        """
+        alone = [
+            i for i, equation in enumerate(equations)
+            if RENDER_ALONE.search(equation)
+        ]
+        if len(equations) > 1 and alone:
+            together = [i for i in range(len(equations)) if i not in alone]
+            parts = [[i] for i in alone] + ([together] if together else [])
+            images = [None] * len(equations)
+            for part in parts:
+                rendered = await self.render_and_cache(
+                    [keys[i] for i in part],
+                    [equations[i] for i in part],
+                    f"{tempfile}_{part[0]}",
+                )
+                for i, image in zip(part, rendered):
+                    images[i] = image
+
+            return images
+
+        try:
+            images = await self.render(equations, tempfile)
+
+        except RenderError:
+            images = [None] * len(equations)
+
+        if len(equations) > 1 and None in images:
+            # a broken equation can spoil the pages of the others, so
+            # render them one by one to find out which ones failed
+            images = []
+            for i, (key, equation) in enumerate(zip(keys, equations)):
+                image, = await self.render_and_cache(
+                    [key], [equation], f"{tempfile}_{i}")
+                images.append(image)
+
+            return images
+
+        for key, image in zip(keys, images):
+            if image is None:
+                self.cache.put_failure(key)
+
+            else:
+                self.cache.put(key, image)
+
+        return images
+
+    async def render(self, equations, tempfile):
+        """Compile the equations in a single document, one per page, and
+        return the PNG images as bytes. The image of an equation that did
+        not compile is None.
+        """
+        pages = "".join(
+            LATEX_EQUATION.replace("%equation%", equation)
+            for equation in equations
+        )
+
+        return await self.renderer.render(pages, len(equations), tempfile)
+
+    @tasks.loop(count=1)
+    async def _start_pool(self):
+        """Build the preamble format and spawn the warm workers."""
+
+        await self.renderer.start()
+
+    @tasks.loop(count=1)
+    async def _create_tables(self):
+        """Create the necessary tables, if they don't already exist."""
+
+        await self.bot.db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS tex_popularity(
+                equation       TEXT      NOT NULL PRIMARY KEY,
+                requests       INTEGER   NOT NULL,
+                last_requested TIMESTAMP NOT NULL
+            )
+            """
+        )
+
+        await self.bot.db.commit()
+
+    @tasks.loop(minutes=5)
+    async def _save_requests(self):
+        """Add the requests of the equations to the DB."""
+
+        if not self.requests:
+            return
+
+        requests, self.requests = self.requests, Counter()
+        now = datetime.utcnow()
+        await self.bot.db.executemany(
+            """
+            INSERT INTO tex_popularity
+            VALUES (:equation, :requests, :last_requested)
+                ON CONFLICT(equation) DO UPDATE
+               SET requests = requests + excluded.requests,
+                   last_requested = excluded.last_requested
+            """,
+            [
+                {"equation": e, "requests": n, "last_requested": now}
+                for e, n in requests.items()
+            ],
+        )
+
+        await self.bot.db.commit()
+
+    @_save_requests.before_loop
+    async def _before_save_requests(self):
+        await self._create_tables.get_task()
+
+    @tasks.loop(count=1)
+    async def _prewarm(self):
+        """Render the most requested equations that are not in the cache,
+        in the background so that members are served first.
+        """
+        await self._create_tables.get_task()
+        await self._start_pool.get_task()
+
+        async with self.bot.db.execute(
+            """
+            SELECT equation
+              FROM tex_popularity
+             ORDER BY requests DESC
+             LIMIT :amount
+            """,
+            {"amount": PREWARM_COUNT},
+        ) as c:
+            rows = await c.fetchall()
+
+        equations = {}  # key -> equation
+        for (equation,) in rows:
+            key = self.get_key(equation)
+            if key not in self.cache:
+                equations[key] = equation
+
+        keys = list(equations)
+        for start in range(0, len(keys), MAX_FILES):
+            batch = keys[start:start + MAX_FILES]
+            await self.scheduler.submit_background(
+                batch,
+                functools.partial(
+                    self.render_keys, equations, f"prewarm_{start}"),
+            )
+
+    @tasks.loop(minutes=1)
+    async def clean_temp_folder(self):
+        """Remove the temporary files that expired, a batch at a time,
+        and save the index of the remaining ones.
+        """
+        while paths := self.temp_files.pop_expired(TEMP_BATCH_SIZE):
+            await asyncio.to_thread(remove_files, paths)
+
+        if self.temp_files.changed:
+            await asyncio.to_thread(
+                self.temp_files.save, self.temp_files.entries())
+
+    @clean_temp_folder.before_loop
+    async def before_clean_temp_folder(self):
+        """Load the index of the temporary files, once at startup."""
+
+        entries = await asyncio.to_thread(self.temp_files.load)
+        self.temp_files.merge(entries)
@@ -0,0 +1,151 @@
+import bisect
+import re
+
+
+VOICE_CHANNEL_NAME = re.compile(r"^(.+)\s(\d+)$")
+
+
+def parse_name(name):
+    """Return the prefix and number of a channel name in the format
+    <Prefix> <Number>, or None.
+    """
+    match = VOICE_CHANNEL_NAME.fullmatch(name)
+    if match is None:
+        return None
+
+    prefix, number = match.group(1, 2)
+    return prefix, int(number)
+
+
+def get_container(channel):
+    """Return the category of the channel, or its guild if it is not in
+    a category.
+    """
+    return channel.category or channel.guild
+
+
+class ChannelGroup:
+    """Voice channels of a category that share a prefix, ordered by
+    number, with the number of members connected to each of them.
+    """
+
+    def __init__(self, guild, container, prefix):
+        self.guild = guild
+        self.container = container
+        self.prefix = prefix
+
+        self.channels = {}  # channel id -> channel
+        self.members = {}  # channel id -> members connected
+        self.empty = set()  # ids of the empty channels
+        self._order = []  # (number, channel id), sorted
+
+    def __len__(self):
+        return len(self.channels)
+
+    def add(self, channel, number, members):
+        if channel.id in self.channels:
+            self.remove(channel.id)
+
+        self.channels[channel.id] = channel
+        self.members[channel.id] = members
+        if members == 0:
+            self.empty.add(channel.id)
+        bisect.insort(self._order, (number, channel.id))
+
+    def remove(self, channel_id):
+        channel = self.channels.pop(channel_id)
+        del self.members[channel_id]
+        self.empty.discard(channel_id)
+        self._order = [e for e in self._order if e[1] != channel_id]
+        return channel
+
+    def join(self, channel_id):
+        """Count a member connecting to the channel."""
+
+        self.members[channel_id] += 1
+        self.empty.discard(channel_id)
+
+    def leave(self, channel_id):
+        """Count a member leaving the channel."""
+
+        self.members[channel_id] = max(0, self.members[channel_id] - 1)
+        if self.members[channel_id] == 0:
+            self.empty.add(channel_id)
+
+    def last(self):
+        """Return the number and the channel with the largest number."""
+
+        number, channel_id = self._order[-1]
+        return number, self.channels[channel_id]
+
+    def empty_channels(self):
+        """Return the numbers and the empty channels, by number."""
+
+        return [
+            (number, self.channels[channel_id])
+            for number, channel_id in self._order
+            if channel_id in self.empty
+        ]
+
+
+class ChannelIndex:
+    """Index of the voice channels in the format <Prefix> <Number>, by
+    category then prefix.
+    Channel names are only parsed when a channel is added or renamed,
+    so that a voice state update is only a lookup.
+    """
+
+    def __init__(self):
+        self._groups = {}  # (container id, prefix) -> group
+        self._channels = {}  # channel id -> (group, number)
+
+    def build(self, guilds):
+        """Index the voice channels of the guilds, from scratch."""
+
+        self._groups.clear()
+        self._channels.clear()
+        for guild in guilds:
+            for channel in guild.voice_channels:
+                self.add(channel)
+
+    def add(self, channel):
+        """Index the channel, if its name is in the right format."""
+
+        self.remove(channel.id)
+        parsed = parse_name(channel.name)
+        if parsed is None:
+            return
+
+        prefix, number = parsed
+        container = get_container(channel)
+        key = (container.id, prefix)
+        group = self._groups.get(key)
+        if group is None:
+            group = self._groups[key] = ChannelGroup(
+                channel.guild, container, prefix)
+
+        group.add(channel, number, len(channel.members))
+        self._channels[channel.id] = (group, number)
+
+    def remove(self, channel_id):
+        """Forget the channel, if it was indexed."""
+
+        group, _ = self._channels.pop(channel_id, (None, None))
+        if group is None:
+            return
+
+        group.remove(channel_id)
+        if not group:
+            del self._groups[(group.container.id, group.prefix)]
+
+    def find(self, channel_id):
+        """Return the group and the number of the channel, or
+        (None, None) if it is not indexed.
+        """
+        return self._channels.get(channel_id, (None, None))
+
+    def get_group(self, container, prefix):
+        return self._groups.get((container.id, prefix))
+
+    def groups(self):
+        return list(self._groups.values())
@@ -0,0 +1,61 @@
+import asyncio
+from collections import defaultdict
+import traceback
+
+
+class Reconciler:
+    """Run `reconcile(container, prefix)` for the voice channel groups
+    marked as dirty.
+    A group is reconciled `delay` seconds after it is marked, so that a
+    burst of events only leads to a single reconciliation, and never
+    twice at the same time. A group marked while it is reconciled is
+    reconciled again afterwards.
+    """
+
+    def __init__(self, reconcile, delay=0.5):
+        self.reconcile = reconcile
+        self.delay = delay
+
+        self._pending = {}  # (container id, prefix) -> task
+        self._locks = defaultdict(asyncio.Lock)
+
+        self.stats = dict(marked=0, runs=0, errors=0)
+
+    def mark(self, group):
+        """Schedule the reconciliation of the group."""
+
+        self.stats["marked"] += 1
+        key = (group.container.id, group.prefix)
+        if key not in self._pending:
+            self._pending[key] = asyncio.create_task(
+                self._run(key, group.container, group.prefix))
+
+    async def _run(self, key, container, prefix):
+        await asyncio.sleep(self.delay)
+        async with self._locks[key]:
+            # the events from now on schedule another run
+            del self._pending[key]
+            self.stats["runs"] += 1
+            try:
+                await self.reconcile(container, prefix)
+
+            except Exception:
+                self.stats["errors"] += 1
+                traceback.print_exc()
+
+    async def join(self):
+        """Wait until no reconciliation is pending or running."""
+
+        while self._pending or self._running():
+            await asyncio.gather(*self._pending.values())
+            for lock in list(self._locks.values()):
+                async with lock:
+                    pass
+
+    def _running(self):
+        return any(lock.locked() for lock in self._locks.values())
+
+    def close(self):
+        for task in self._pending.values():
+            task.cancel()
+        self._pending.clear()
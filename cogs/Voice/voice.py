@@ -1,13 +1,16 @@
-import re
-
 import discord
 from discord.ext import commands
 
+import config
+from .index import ChannelIndex
+from .reconciler import Reconciler
+
 
-class NotPrefixNumberFormatError(Exception):
-    """Error raised when a voice channel does not have the
-    <Prefix> <Number> format.
-    """
+# empty channels kept in each group, so that members always find one
+SPARE_CHANNELS = getattr(config, "voice_spare_channels", 1)
+
+# seconds to wait for the events of a burst before changing the channels
+RECONCILE_DELAY = 0.5
 
 
 class Voice(commands.Cog):
@@ -15,112 +18,128 @@ class Voice(commands.Cog):
 
     def __init__(self, bot):
         self.bot = bot
-        self.voice_channel_name_pattern = r"^(.+)\s(\d+)$"
+        self.index = ChannelIndex()
+        self.reconciler = Reconciler(
+            self.reconcile_channels, delay=RECONCILE_DELAY)
 
-    @commands.Cog.listener(name="on_voice_state_update")
-    async def create_voice_channel(self, member, before, after):
-        """Crée un nouveau VoiceChannel si ceux du format <Prefix> <Number>
-        sont tous occupés.
-        A besoin de la permission "Manage Channels".
-        """
-        if after.channel is not None:
-            # if the member connects to a voice channel
-            category_after = self.get_category_channel_of_voice(after)
-            try:
-                prefix, number = self.get_prefix_number(after.channel)
-            except NotPrefixNumberFormatError:
-                return
-
-            # check number of empty channels
-            prefixed_channels = self.get_matching_voice_channels(
-                category_after, prefix)
-            empty = self.empty_voice_channels(prefixed_channels)
-
-            if len(empty) == 0:
-                last_channel = prefixed_channels[-1]
-                prefix, number = self.get_prefix_number(last_channel)
-                new_channel_name = f"{prefix} {number + 1}"
-                new_channel = await category_after.create_voice_channel(
-                    new_channel_name,
-                    reason="Channel auto create",
-                    bitrate=member.guild.bitrate_limit,
-                )
-                await new_channel.edit(position=last_channel.position + 1)
+        if self.bot.is_ready():
+            # reloaded, on_ready will not be called
+            self.build_index()
 
-    @commands.Cog.listener(name="on_voice_state_update")
-    async def delete_voice_channel(self, member, before, after):
-        """Efface le VoiceChannel si il est vide, tout en laissant le
-        channel 1.
-        A besoin de la permission "Manage Channels".
+    def cog_unload(self):
+        self.reconciler.close()
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        self.build_index()
+
+    def build_index(self):
+        """Index the voice channels, and create or trim the spare
+        channels of every group.
         """
-        if before.channel is not None:
-            # if the member was in a voice channel before
-            category_before = self.get_category_channel_of_voice(before)
-            try:
-                prefix, number = self.get_prefix_number(before.channel)
-            except NotPrefixNumberFormatError:
-                return
-
-            # check number of empty channels
-            prefixed_channels = self.get_matching_voice_channels(
-                category_before, prefix)
-            empty = self.empty_voice_channels(prefixed_channels)
-            vc_names = '\n'.join([vc.name for vc in empty])
-
-            if len(empty) > 1:
-                to_delete = empty[-1]  # delete the last empty channel
-                prefix, number = self.get_prefix_number(to_delete)
-
-                if number == 1:
-                    print(
-                        "TRIED TO DELETE CHANNEL 1\n"
-                        f"{vc_names}"
-                    )
-                    return
-
-                try:
-                    await to_delete.delete(reason="Channel auto delete")
-
-                except discord.NotFound:
-                    # channel already deleted, probably
-                    pass
-
-    def get_prefix_number(self, channel):
-        """Get the prefix and number of a channel's name, if it is in
-        the format <Prefix> <Number>, otherwise raise SomeError.
+        self.index.build(self.bot.guilds)
+        for group in self.index.groups():
+            self.reconciler.mark(group)
+
+    @commands.Cog.listener()
+    async def on_guild_channel_create(self, channel):
+        if isinstance(channel, discord.VoiceChannel):
+            self.index.add(channel)
+
+    @commands.Cog.listener()
+    async def on_guild_channel_delete(self, channel):
+        if isinstance(channel, discord.VoiceChannel):
+            self.index.remove(channel.id)
+
+    @commands.Cog.listener()
+    async def on_guild_channel_update(self, before, after):
+        if (isinstance(after, discord.VoiceChannel)
+                and (before.name != after.name
+                     or before.category_id != after.category_id)):
+            self.index.add(after)
+
+    @commands.Cog.listener()
+    async def on_voice_state_update(self, member, before, after):
+        """Garde SPARE_CHANNELS VoiceChannels vides du format
+        <Prefix> <Number> par préfixe, en créant ou effaçant des channels.
+        A besoin de la permission "Manage Channels".
         """
+        if before.channel == after.channel:
+            # muted, deafened, streaming...
+            return
 
-        match = re.fullmatch(self.voice_channel_name_pattern, channel.name)
-        if match:
-            prefix, number = match.group(1, 2)
-            number = int(number)
-            return prefix, number
-
-        else:
-            raise NotPrefixNumberFormatError(
-                f"{channel.name} does not have the right format.")
+        if before.channel is not None:
+            group, _ = self.index.find(before.channel.id)
+            if group is not None:
+                group.leave(before.channel.id)
+                self.reconciler.mark(group)
 
-    def get_matching_voice_channels(self, category, prefix):
-        """Return a list of the voice channels with the matching prefix
-        in the category.
+        if after.channel is not None:
+            group, _ = self.index.find(after.channel.id)
+            if group is not None:
+                group.join(after.channel.id)
+                self.reconciler.mark(group)
+
+    async def reconcile_channels(self, container, prefix):
+        """Crée ou efface des VoiceChannels pour qu'il en reste
+        SPARE_CHANNELS vides dans le groupe, en gardant toujours le
+        channel 1.
         """
-        return [vc for vc in category.voice_channels
-                if re.fullmatch(rf"^{prefix}\s\d+$", vc.name)]
+        group = self.index.get_group(container, prefix)
+        if group is None:
+            return
+
+        empty = group.empty_channels()
+        if len(empty) < SPARE_CHANNELS:
+            number, last_channel = group.last()
+            new_channels = []
+            for i in range(SPARE_CHANNELS - len(empty)):
+                new_channel = await container.create_voice_channel(
+                    f"{prefix} {number + 1 + i}",
+                    reason="Channel auto create",
+                    bitrate=group.guild.bitrate_limit,
+                )
+                # do not wait for on_guild_channel_create to count it
+                self.index.add(new_channel)
+                new_channels.append(new_channel)
 
-    def get_category_channel_of_voice(self, voice_state):
-        """Return the category that the voice channel associated with the
-        VoiceState is in. Return the Guild if the VoiceStateis not in a
-        category or None if it isn't connected.
-        """
-        try:
-            channel = voice_state.channel
+            await self.move_channels_after(
+                group.guild, new_channels, last_channel)
+            return
 
-        except AttributeError:
-            return None
+        # keep the first empty channels, with channel 1 if it is empty
+        for number, channel in empty[SPARE_CHANNELS:]:
+            if number == 1 or channel.id not in group.empty:
+                # a member joined it in the meantime
+                continue
 
-        return channel.category or channel.guild
+            self.index.remove(channel.id)
+            try:
+                await channel.delete(reason="Channel auto delete")
 
-    def empty_voice_channels(self, channels):
-        """Return a list of empty VoiceChannels in the list channels."""
+            except discord.NotFound:
+                # channel already deleted, probably
+                pass
 
-        return [vc for vc in channels if not vc.members]
+    async def move_channels_after(self, guild, channels, after):
+        """Place les channels après le channel `after`, en une seule
+        requête pour tous les channels déplacés.
+        """
+        bucket = after._sorting_bucket
+        moved = {channel.id for channel in channels}
+        # the new channels might not be in the guild's cache yet
+        ordered = sorted(
+            (c for c in guild.channels
+             if c._sorting_bucket == bucket and c.id not in moved),
+            key=lambda c: c.position,
+        )
+        index = ordered.index(after) + 1
+        ordered[index:index] = channels
+
+        payload = [
+            {"id": channel.id, "position": position}
+            for position, channel in enumerate(ordered)
+            if channel.position != position or channel.id in moved
+        ]
+        await self.bot.http.bulk_channel_update(
+            guild.id, payload, reason="Channel auto create")
@@ -0,0 +1,70 @@
+import asyncio
+from collections import OrderedDict
+import time
+
+
+def normalize_query(query):
+    """Return the query with its insignificant whitespace collapsed, so
+    that `speed of light` and ` speed  of light` share the same result.
+    The case is kept, `G` and `g` are different constants.
+    """
+    return " ".join(query.split())
+
+
+class ResultCache:
+    """LRU of the latest `size` query results, each valid until its
+    expiration time, in seconds since the epoch.
+    """
+
+    def __init__(self, size=256):
+        self.size = size
+
+        self._results = OrderedDict()  # key -> (expires at, result)
+
+    def get(self, key):
+        """Return the result stored under `key`, or None if it is
+        missing or expired.
+        """
+        expires_at, result = self._results.get(key, (0, None))
+        if expires_at <= time.time():
+            self._results.pop(key, None)
+            return None
+
+        self._results.move_to_end(key)
+        return result
+
+    def put(self, key, result, expires_at):
+        """Store the result under `key` until `expires_at`."""
+
+        self._results[key] = (expires_at, result)
+        self._results.move_to_end(key)
+        while len(self._results) > self.size:
+            self._results.popitem(last=False)
+
+
+class SingleFlight:
+    """Run a single coroutine at a time per key, the callers asking for
+    a key that is already running wait for the same result instead.
+    """
+
+    def __init__(self):
+        self._inflight = {}  # key -> task
+
+        self.stats = dict(started=0, coalesced=0)
+
+    async def run(self, key, factory):
+        """Return the result of `factory()`, or of the coroutine already
+        running under `key`.
+        """
+        task = self._inflight.get(key)
+        if task is None:
+            self.stats["started"] += 1
+            task = asyncio.ensure_future(factory())
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+
+        else:
+            self.stats["coalesced"] += 1
+
+        # a caller that gives up does not cancel the others
+        return await asyncio.shield(task)
@@ -0,0 +1,148 @@
+import asyncio
+from collections import OrderedDict, deque
+import time
+
+from discord.ext import commands
+
+
+class QueueFull(commands.CommandError):
+    """Error raised when a request can not wait for its turn."""
+
+
+class QuotaExhausted(commands.CommandError):
+    """Error raised when the requests of the month are all used."""
+
+
+def current_month():
+    return time.strftime("%Y-%m", time.gmtime())
+
+
+class RateLimiter:
+    """Token bucket in front of the Wolfram|Alpha API.
+    Requests are allowed `rate` per second, with bursts of up to `burst`
+    requests. The requests waiting for a token are served round-robin
+    between users, and at most `max_queued` of them can wait, including
+    `max_queued_user` per user.
+    At most `quota` requests are allowed each month, `used` counts the
+    ones of the current month.
+    """
+
+    def __init__(self, rate=1, burst=5, max_queued=20, max_queued_user=2,
+                 quota=2000):
+        self.rate = rate
+        self.burst = burst
+        self.max_queued = max_queued
+        self.max_queued_user = max_queued_user
+        self.quota = quota
+
+        self.month = current_month()
+        self.used = 0
+
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._queues = OrderedDict()  # user -> deque of (future, queued at)
+        self._queued = 0
+        self._task = None
+
+        self.waits = deque(maxlen=1000)  # seconds spent in the queue
+        self.stats = dict(granted=0, rejected=0, exhausted=0)
+
+    @property
+    def depth(self):
+        return self._queued
+
+    @property
+    def remaining(self):
+        self._roll_month()
+        return max(0, self.quota - self.used)
+
+    @property
+    def tokens(self):
+        self._refill()
+        return self._tokens
+
+    async def acquire(self, user_id):
+        """Wait for the turn of the user to send a request.
+        Raise QuotaExhausted if the quota of the month is used, and
+        QueueFull if too many requests are waiting.
+        """
+        if self.remaining <= self._queued:
+            self.stats["exhausted"] += 1
+            raise QuotaExhausted(
+                "No more Wolfram|Alpha queries this month, sorry!")
+
+        queue = self._queues.get(user_id, ())
+        if (self._queued >= self.max_queued
+                or len(queue) >= self.max_queued_user):
+            self.stats["rejected"] += 1
+            raise QueueFull(
+                "Too many Wolfram|Alpha queries are waiting, "
+                "try again in a moment.")
+
+        future = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(user_id, deque()).append(
+            (future, time.perf_counter()))
+        self._queued += 1
+
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._grant())
+
+        await future
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(
+            self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _roll_month(self):
+        month = current_month()
+        if month != self.month:
+            self.month = month
+            self.used = 0
+
+    def _next_waiter(self):
+        """Pop the next waiting request, round-robin between users."""
+
+        user_id, waiters = next(iter(self._queues.items()))
+        waiter = waiters.popleft()
+        self._queued -= 1
+
+        if waiters:
+            self._queues.move_to_end(user_id)
+        else:
+            del self._queues[user_id]
+
+        return waiter
+
+    async def _grant(self):
+        """Give the tokens to the waiting requests as they come."""
+
+        while self._queued:
+            self._refill()
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                continue
+
+            future, queued_at = self._next_waiter()
+            if future.cancelled():
+                # the command gave up
+                continue
+
+            self._tokens -= 1
+            self._roll_month()
+            self.used += 1
+            self.stats["granted"] += 1
+            self.waits.append(time.perf_counter() - queued_at)
+            future.set_result(None)
+
+    def wait_percentile(self, percentile):
+        """Return the given percentile of the recent queue waits, in
+        seconds.
+        """
+        if not self.waits:
+            return 0.0
+
+        waits = sorted(self.waits)
+        index = min(len(waits) - 1, int(percentile / 100 * len(waits)))
+        return waits[index]
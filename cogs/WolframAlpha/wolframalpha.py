@@ -1,15 +1,59 @@
+import asyncio
+from collections import deque
 import io
+import json
+import time
+
 import discord
-from discord.ext import commands
+from discord.ext import commands, tasks
 import aiowolframalpha
 
 import config
+from .cache import ResultCache, SingleFlight, normalize_query
+from .limiter import QueueFull, QuotaExhausted, RateLimiter
+
+
+# where the API is, to use a stand-in server
+API_URL = getattr(config, "wolfram_api_url", "https://api.wolframalpha.com")
+
+# seconds a query result is kept, and results kept in memory
+CACHE_TTL = getattr(config, "wolfram_cache_ttl", 6 * 3600)
+CACHE_MEMORY_SIZE = getattr(config, "wolfram_cache_memory_size", 256)
+# seconds a simple query image is kept in memory, and images kept
+SIMPLE_CACHE_TTL = getattr(config, "wolfram_simple_cache_ttl", 300)
+SIMPLE_CACHE_SIZE = getattr(config, "wolfram_simple_cache_size", 32)
+# bytes of a simple query image downloaded at most
+SIMPLE_MAX_SIZE = getattr(config, "wolfram_simple_max_size", 25 * 2**20)
+# requests allowed per second and in a burst, requests allowed to wait in
+# total and per member, and requests allowed per month
+RATE = getattr(config, "wolfram_rate", 1)
+BURST = getattr(config, "wolfram_burst", 5)
+QUEUE_SIZE = getattr(config, "wolfram_queue_size", 20)
+QUEUE_SIZE_MEMBER = getattr(config, "wolfram_queue_size_member", 2)
+MONTHLY_QUOTA = getattr(config, "wolfram_monthly_quota", 2000)
+# reply with the first pods while the others are computed, which costs an
+# extra request for the queries that are not cached
+PROGRESSIVE = getattr(config, "wolfram_progressive", True)
+
+# seconds to wait for the full result before asking for the first pods,
+# and between the first reply and its edit
+FIRST_PODS_DELAY = 1
+EDIT_INTERVAL = 1
+
+# widths of the simple query images, the next one is asked for if the
+# image is too big to be sent
+SIMPLE_WIDTHS = (600, 400, 300)
+DOWNLOAD_CHUNK_SIZE = 64 * 2**10
 
 
 class QueryError(commands.CommandError):
     pass
 
 
+class ImageTooLarge(QueryError):
+    pass
+
+
 class WolframAlpha(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
@@ -17,62 +61,150 @@ class WolframAlpha(commands.Cog):
             config.wolfram_alpha_api,
             session=self.bot.http_session,
         )
+        # the client sends the full queries to its url
+        self.wolfram_client.url = f"{API_URL}/v2/query"
+        self.cache = ResultCache(size=CACHE_MEMORY_SIZE)
+        self.simple_cache = ResultCache(size=SIMPLE_CACHE_SIZE)
+        self.requests = SingleFlight()
+        self.limiter = RateLimiter(
+            rate=RATE,
+            burst=BURST,
+            max_queued=QUEUE_SIZE,
+            max_queued_user=QUEUE_SIZE_MEMBER,
+            quota=MONTHLY_QUOTA,
+        )
+        self.stats = dict(memory_hits=0, db_hits=0, misses=0, simple_hits=0)
+        self.downloads = deque(maxlen=100)  # (bytes, seconds)
+
+        self._create_tables.start()
+        self._purge_cache.start()
+
+    def cog_unload(self):
+        self._create_tables.cancel()
+        self._purge_cache.cancel()
 
     @commands.group(aliases=["wa"], invoke_without_command=True)
     async def wolfram(self, ctx, *, query):
         """Wolfram|Alpha query command.
         Return the data in a nicely formatted Embed.
         """
-        embed = discord.Embed(
-            title="Wolfram|Alpha",
-            description=f"Results for query ``{query}``",
-            color=0xdd1100,
-        )
-
         async with ctx.typing():
-            result = await self.wolfram_client.query(query)
-
-            if result.success == "false":
-                raise QueryError(
-                    "The query failed. Maybe try a different query?")
+            full = asyncio.ensure_future(
+                self.get_wolfram_query(query, ctx.author.id))
+            first = None
+            if PROGRESSIVE:
+                # cached results come back without waiting
+                await asyncio.wait({full}, timeout=FIRST_PODS_DELAY)
+                if not full.done():
+                    first = await self.get_wolfram_first_pods(
+                        query, ctx.author.id)
 
-            for pod in result.pods:
-                value = []
+            if first is None or full.done():
+                await ctx.reply(embed=self.make_embed(query, await full))
+                return
 
-                for subpod in pod.subpods:
-                    image = next(subpod.img)
+            message = await ctx.reply(
+                embed=self.make_embed(query, first, partial=True))
+            sent_at = time.monotonic()
 
-                    plaintext = subpod.plaintext
-                    if plaintext is not None:
-                        value.append(f"• {plaintext}")
+        try:
+            result = await full
 
-                    elif (embed.image.url == discord.Embed.Empty
-                          and image is not None):
-                        embed.set_image(
-                            url=image.src,
-                        )
+        except Exception:
+            await message.edit(embed=self.make_embed(query, first))
+            raise
 
-                value = discord.utils.escape_markdown("\n".join(value))
-                if value:
-                    if len(value) > 1024:
-                        value = "Too long to display."
-                    embed.add_field(
-                        name=pod.title,
-                        value=value,
-                    )
-
-            await ctx.reply(embed=embed)
+        # no need to edit faster than Discord allows
+        await asyncio.sleep(EDIT_INTERVAL - (time.monotonic() - sent_at))
+        await message.edit(embed=self.make_embed(query, result))
 
     @wolfram.command(name="simple", aliases=["s"])
     async def wolfram_simple(self, ctx, *, query):
         """Simple Wolfram|Alpha query command.
         Return the data in an already generated image from Wolfram itself.
         """
+        if ctx.guild is not None:
+            limit = ctx.guild.filesize_limit
+        else:
+            limit = discord.utils.DEFAULT_FILE_SIZE_LIMIT_BYTES
+
         async with ctx.typing():
-            result = await self.get_wolfram_simple_query(query)
-            file = discord.File(result, filename="wolfram_alpha_result.png")
+            for width in SIMPLE_WIDTHS:
+                try:
+                    result = await self.get_wolfram_simple_query(
+                        query, ctx.author.id, width)
+
+                except ImageTooLarge:
+                    continue
+
+                if len(result) <= limit:
+                    break
+
+            else:
+                raise ImageTooLarge("The result is too big to be sent.")
+
+            file = discord.File(
+                io.BytesIO(result), filename="wolfram_alpha_result.png")
             await ctx.reply(file=file)
 
+    @wolfram.command(name="quota")
+    @commands.is_owner()
+    async def wolfram_quota(self, ctx):
+        """Show the API budget, the queue and the cache counters."""
+
+        limiter = self.limiter
+        embed = discord.Embed(
+            title="Wolfram|Alpha usage",
+            color=0xdd1100,
+        ).add_field(
+            name="Budget",
+            value=(
+                f"Month: {limiter.month}\n"
+                f"Used: {limiter.used} / {limiter.quota}\n"
+                f"Remaining: {limiter.remaining}\n"
+                f"Tokens: {limiter.tokens:.1f} / {limiter.burst} "
+                f"({limiter.rate} per second)"
+            ),
+            inline=False,
+        ).add_field(
+            name="Queue",
+            value=(
+                f"Depth: {limiter.depth} / {limiter.max_queued}\n"
+                f"Wait p50: {limiter.wait_percentile(50) * 1000:.0f} ms, "
+                f"p95: {limiter.wait_percentile(95) * 1000:.0f} ms\n"
+                f"Rejected: {limiter.stats['rejected']}, "
+                f"over quota: {limiter.stats['exhausted']}"
+            ),
+            inline=False,
+        ).add_field(
+            name="Cache",
+            value=(
+                f"Memory: {self.stats['memory_hits']}, "
+                f"DB: {self.stats['db_hits']}, "
+                f"images: {self.stats['simple_hits']}\n"
+                f"Misses: {self.stats['misses']}\n"
+                f"Coalesced: {self.requests.stats['coalesced']}"
+            ),
+            inline=False,
+        )
+
+        if self.downloads:
+            sizes, times = zip(*self.downloads)
+            times = sorted(times)
+            embed.add_field(
+                name="Images",
+                value=(
+                    f"Downloads: {len(sizes)}, "
+                    f"mean {sum(sizes) / len(sizes) / 2**10:.0f} KiB, "
+                    f"max {max(sizes) / 2**10:.0f} KiB\n"
+                    f"Time p50: {times[len(times) // 2] * 1000:.0f} ms, "
+                    f"max: {times[-1] * 1000:.0f} ms"
+                ),
+                inline=False,
+            )
+
+        await ctx.reply(embed=embed)
+
     @wolfram.error
     @wolfram_simple.error
     async def wolfram_error(self, ctx, error):
@@ -81,17 +213,147 @@ class WolframAlpha(commands.Cog):
         error = getattr(error, "original", error)
 
         if isinstance(error, (commands.MissingRequiredArgument,
-                              QueryError)):
+                              QueryError,
+                              QueueFull,
+                              QuotaExhausted)):
             await ctx.reply(error)
 
         else:
             await ctx.reply("Something went wrong!")
             raise error
 
-    async def get_wolfram_simple_query(self, query):
+    def make_embed(self, query, result, partial=False):
+        """Return the embed of the query results, with a notice if more
+        results are coming.
+        """
+        embed = discord.Embed(
+            title="Wolfram|Alpha",
+            description=f"Results for query ``{query}``",
+            color=0xdd1100,
+        )
+        for name, value in result["fields"]:
+            embed.add_field(name=name, value=value)
+
+        if result["image"] is not None:
+            embed.set_image(url=result["image"])
+
+        if partial:
+            embed.set_footer(text="Loading more results...")
+
+        return embed
+
+    async def get_wolfram_query(self, query, user_id):
+        """Return the fields and the image of the embed of the query
+        results, from the cache if possible.
+        """
+        key = normalize_query(query)
+        result = self.cache.get(key)
+        if result is not None:
+            self.stats["memory_hits"] += 1
+            return result
+
+        # the same query asked at the same time is only sent once
+        return await self.requests.run(
+            ("full", key),
+            lambda: self._get_wolfram_query(key, query, user_id),
+        )
+
+    async def _get_wolfram_query(self, key, query, user_id):
+        row = await self._get_cached_result(key)
+        if row is not None:
+            self.stats["db_hits"] += 1
+            result = json.loads(row["result"])
+            self.cache.put(key, result, row["expires_at"])
+            return result
+
+        self.stats["misses"] += 1
+        await self.acquire(user_id)
+        result = await self.build_wolfram_result(query)
+        expires_at = time.time() + CACHE_TTL
+        self.cache.put(key, result, expires_at)
+        await self._cache_result(key, result, expires_at)
+
+        return result
+
+    async def get_wolfram_first_pods(self, query, user_id):
+        """Return the fields and the image of the embed of the first pods
+        of the query results, usually the input interpretation and the
+        primary result, or None if they can not be fetched.
+        These partial results are not cached.
+        """
+        try:
+            result = await self.requests.run(
+                ("first", normalize_query(query)),
+                lambda: self._get_wolfram_first_pods(query, user_id),
+            )
+
+        except (QueryError, QueueFull, QuotaExhausted):
+            return None
+
+        return result if result["fields"] else None
+
+    async def _get_wolfram_first_pods(self, query, user_id):
+        await self.acquire(user_id)
+        return await self.build_wolfram_result(query, podindex="1,2")
+
+    async def build_wolfram_result(self, query, **parameters):
+        """Send the query to Wolfram|Alpha and return the fields of the
+        embed, and the URL of the first image without text if any.
+        """
+        result = await self.wolfram_client.query(query, **parameters)
+
+        if result.success == "false":
+            raise QueryError(
+                "The query failed. Maybe try a different query?")
+
+        fields = []
+        embed_image = None
+        for pod in result.pods:
+            value = []
+
+            for subpod in pod.subpods:
+                image = next(subpod.img)
+
+                plaintext = subpod.plaintext
+                if plaintext is not None:
+                    value.append(f"• {plaintext}")
+
+                elif embed_image is None and image is not None:
+                    embed_image = image.src
+
+            value = discord.utils.escape_markdown("\n".join(value))
+            if value:
+                if len(value) > 1024:
+                    value = "Too long to display."
+                fields.append((pod.title, value))
+
+        return dict(fields=fields, image=embed_image)
+
+    async def get_wolfram_simple_query(self, query, user_id, width=600):
+        """Return the image generated by Wolfram|Alpha for the query, as
+        bytes. The latest images are kept for a few minutes.
+        """
+        key = f"{width}:{normalize_query(query)}"
+        result = self.simple_cache.get(key)
+        if result is not None:
+            self.stats["simple_hits"] += 1
+            return result
+
+        result = await self.requests.run(
+            ("simple", key),
+            lambda: self._get_wolfram_simple_query(query, user_id, width),
+        )
+        self.simple_cache.put(key, result, time.time() + SIMPLE_CACHE_TTL)
+
+        return result
+
+    async def _get_wolfram_simple_query(self, query, user_id, width):
         """Function to send the query to Wolfram|Alpha and return the
         generated image.
+        The image is downloaded in chunks, and ImageTooLarge is raised as
+        soon as it gets bigger than the limit.
         """
+        await self.acquire(user_id)
         parameters = {
             "i": query,
             "appid": config.wolfram_alpha_api,
@@ -99,18 +361,140 @@ class WolframAlpha(commands.Cog):
             "background": "36393F",  # default: "white"
             "foreground": "white",  # default: "black"
             "fontsize": 14,  # default: 14
-            "width": 600,  # default: 500
+            "width": width,  # default: 500
             "units": "metric",  # default: location based
         }
 
-        url = "http://api.wolframalpha.com/v1/simple"
+        url = f"{API_URL}/v1/simple"
+        start = time.perf_counter()
         async with self.bot.http_session.get(url, params=parameters) as resp:
-            if resp.status == 200:
-                result = io.BytesIO(await resp.content.read())
-                result.seek(0)
-
-                return result
-
-            else:
+            if (resp.status != 200
+                    or not resp.content_type.startswith("image/")):
                 raise QueryError(
                     "The query failed. Maybe try a different query?")
+
+            if (resp.content_length or 0) > SIMPLE_MAX_SIZE:
+                raise ImageTooLarge("The result is too big to be sent.")
+
+            result = bytearray()
+            async for chunk in resp.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                result += chunk
+                if len(result) > SIMPLE_MAX_SIZE:
+                    raise ImageTooLarge("The result is too big to be sent.")
+
+        self.downloads.append((len(result), time.perf_counter() - start))
+        return bytes(result)
+
+    async def acquire(self, user_id):
+        """Wait for the turn of the member to send a request, and count
+        it in the usage of the month.
+        """
+        await self.limiter.acquire(user_id)
+        await self._save_usage(self.limiter.month, self.limiter.used)
+
+    @tasks.loop(count=1)
+    async def _create_tables(self):
+        """Create the necessary tables, if they don't already exist."""
+
+        await self.bot.db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS wolfram_cache(
+                query      TEXT NOT NULL PRIMARY KEY,
+                result     TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            )
+            """
+        )
+
+        await self.bot.db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS wolfram_usage(
+                month    TEXT    NOT NULL PRIMARY KEY,
+                requests INTEGER NOT NULL
+            )
+            """
+        )
+
+        await self.bot.db.commit()
+
+        # requests of the month sent before a restart
+        self.limiter.used += await self._get_usage(self.limiter.month)
+
+    @tasks.loop(hours=1)
+    async def _purge_cache(self):
+        """Remove the expired results from the DB."""
+
+        await self.bot.db.execute(
+            """
+            DELETE FROM wolfram_cache
+             WHERE expires_at <= :now
+            """,
+            {"now": time.time()},
+        )
+
+        await self.bot.db.commit()
+
+    @_purge_cache.before_loop
+    async def _before_purge_cache(self):
+        await self._create_tables.get_task()
+
+    async def _get_cached_result(self, query):
+        """Get the result of a query that did not expire."""
+
+        async with self.bot.db.execute(
+            """
+            SELECT result, expires_at
+              FROM wolfram_cache
+             WHERE query = :query
+               AND expires_at > :now
+            """,
+            {"query": query, "now": time.time()},
+        ) as c:
+            row = await c.fetchone()
+
+        return row
+
+    async def _cache_result(self, query, result, expires_at):
+        """Save the result of a query to the DB."""
+
+        await self.bot.db.execute(
+            """
+            INSERT OR REPLACE INTO wolfram_cache
+            VALUES (:query, :result, :expires_at)
+            """,
+            {
+                "query": query,
+                "result": json.dumps(result),
+                "expires_at": expires_at,
+            },
+        )
+
+        await self.bot.db.commit()
+
+    async def _get_usage(self, month):
+        """Get the number of requests sent during the month."""
+
+        async with self.bot.db.execute(
+            """
+            SELECT requests
+              FROM wolfram_usage
+             WHERE month = :month
+            """,
+            {"month": month},
+        ) as c:
+            row = await c.fetchone()
+
+        return row["requests"] if row is not None else 0
+
+    async def _save_usage(self, month, requests):
+        """Save the number of requests sent during the month."""
+
+        await self.bot.db.execute(
+            """
+            INSERT OR REPLACE INTO wolfram_usage
+            VALUES (:month, :requests)
+            """,
+            {"month": month, "requests": requests},
+        )
+
+        await self.bot.db.commit()
@@ -0,0 +1,13 @@
+"""Tests of the cogs.
+Run them from the root of the repository, with
+`python -m unittest`.
+"""
+import sys
+import types
+
+try:
+    import config  # noqa: F401
+
+except ImportError:
+    # the cogs only read optional settings from it
+    sys.modules["config"] = types.ModuleType("config")
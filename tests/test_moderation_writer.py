@@ -0,0 +1,67 @@
+import sqlite3
+import unittest
+
+import aiosqlite
+
+from cogs.Moderation.writer import LogWriter
+
+
+INSERT = "INSERT INTO log VALUES (:id, :content)"
+
+
+class TestLogWriter(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.db = await aiosqlite.connect(":memory:")
+        await self.db.execute(
+            "CREATE TABLE log(id INTEGER PRIMARY KEY, content TEXT NOT NULL)")
+        self.writer = LogWriter(self.db, batch_size=1000, interval=60)
+
+    async def asyncTearDown(self):
+        await self.db.close()
+
+    async def logged_ids(self):
+        async with self.db.execute("SELECT id FROM log ORDER BY id") as c:
+            return [row[0] for row in await c.fetchall()]
+
+    async def test_rows_inserted(self):
+        await self.writer.put_many(
+            INSERT, [dict(id=i, content="message") for i in range(10)])
+        await self.writer.close()
+
+        self.assertEqual(await self.logged_ids(), list(range(10)))
+        self.assertEqual(self.writer.stats["rows"], 10)
+
+    async def test_bad_row_among_good_ones(self):
+        rows = [dict(id=i, content="message") for i in range(10)]
+        rows[6]["content"] = None
+        await self.writer.put_many(INSERT, rows)
+        await self.writer.close()
+
+        self.assertEqual(
+            await self.logged_ids(), [i for i in range(10) if i != 6])
+        self.assertEqual(self.writer.stats["rows"], 9)
+        self.assertEqual(self.writer.stats["dropped"], 1)
+
+    async def test_other_writes_kept(self):
+        # a write of another cog, not committed yet
+        await self.db.execute("CREATE TABLE other(value INTEGER)")
+        await self.db.execute("INSERT INTO other VALUES (1)")
+        await self.writer.put(INSERT, dict(id=1, content=None))
+        await self.writer.close()
+
+        await self.db.commit()
+        async with self.db.execute("SELECT value FROM other") as c:
+            self.assertEqual(await c.fetchall(), [(1,)])
+
+    async def test_database_error_retried(self):
+        await self.writer.put("INSERT INTO missing VALUES (:id)", dict(id=1))
+        await self.writer.flush()
+
+        self.assertEqual(self.writer.stats["errors"], 1)
+        self.assertEqual(self.writer._pending, 1)
+        with self.assertRaises(sqlite3.OperationalError):
+            await self.db.execute("SELECT * FROM missing")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,24 @@
+import unittest
+
+from cogs.TeX.cache import render_key
+from cogs.TeX.tex import find_equations, strip_equation
+
+
+class TestRenderKey(unittest.TestCase):
+    def key(self, content):
+        (match,) = find_equations(content)
+        return render_key(strip_equation(match), "template")
+
+    def test_strip_equation(self):
+        self.assertEqual(strip_equation("`$ a+b $`"), "a+b")
+
+    def test_whitespace_shares_key(self):
+        self.assertEqual(self.key("`$a+b$`"), self.key("`$ a+b $`"))
+        self.assertEqual(self.key("`$a + b$`"), self.key("`$ a  +  b $`"))
+
+    def test_different_equations(self):
+        self.assertNotEqual(self.key("`$a+b$`"), self.key("`$a-b$`"))
+
+
+if __name__ == "__main__":
+    unittest.main()
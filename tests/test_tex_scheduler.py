@@ -0,0 +1,74 @@
+import asyncio
+import unittest
+
+from cogs.TeX.scheduler import QueueFull, RenderScheduler
+
+
+class TestRenderScheduler(unittest.IsolatedAsyncioTestCase):
+    async def render(self, keys):
+        await asyncio.sleep(0)
+        return [f"image {key}" for key in keys]
+
+    async def test_results_in_order(self):
+        scheduler = RenderScheduler()
+        images = await scheduler.submit(["a", "b", "a"], 1, 1, self.render)
+        self.assertEqual(images, ["image a", "image b", "image a"])
+
+    async def test_oversized_submission(self):
+        scheduler = RenderScheduler(max_queued=100, max_queued_owner=10)
+        keys = [f"key {i}" for i in range(50)]
+        with self.assertRaises(QueueFull):
+            await scheduler.submit(keys, 1, 1, self.render)
+
+        self.assertEqual(scheduler.depth, 0)
+        self.assertEqual(scheduler.stats["rejected"], 1)
+
+    async def test_queue_limit(self):
+        scheduler = RenderScheduler(
+            concurrency=1, max_queued=5, max_queued_owner=10)
+        # holds the only slot, so the next submissions stay queued
+        running = asyncio.create_task(
+            scheduler.submit(["running"], 1, 1, self.render))
+        await asyncio.sleep(0)
+
+        queued = asyncio.create_task(
+            scheduler.submit(["a", "b", "c"], 1, 2, self.render))
+        await asyncio.sleep(0)
+        with self.assertRaises(QueueFull):
+            await scheduler.submit(["d", "e", "f"], 1, 3, self.render)
+
+        self.assertEqual(await queued, ["image a", "image b", "image c"])
+        await running
+
+    async def test_background_job_joined(self):
+        scheduler = RenderScheduler(concurrency=2)
+        release = asyncio.Event()
+
+        async def blocked(keys):
+            await release.wait()
+            return await self.render(keys)
+
+        # the queue is never empty, so the background job cannot start
+        busy = [
+            asyncio.create_task(
+                scheduler.submit([f"busy {i}"], 1, i, blocked))
+            for i in range(3)
+        ]
+        prewarm = asyncio.create_task(
+            scheduler.submit_background(["a", "b"], self.render))
+        await asyncio.sleep(0)
+
+        # the member's job takes the place of the first busy one to end
+        joined = asyncio.create_task(
+            scheduler.submit(["b"], 2, 1, self.render))
+        await asyncio.sleep(0)
+        self.assertEqual(scheduler.stats["promoted"], 1)
+        release.set()
+
+        self.assertEqual(await joined, ["image b"])
+        self.assertEqual(await prewarm, ["image a", "image b"])
+        await asyncio.gather(*busy)
+
+
+if __name__ == "__main__":
+    unittest.main()
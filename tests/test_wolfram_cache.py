@@ -0,0 +1,19 @@
+import unittest
+
+from cogs.WolframAlpha.cache import normalize_query
+
+
+class TestNormalizeQuery(unittest.TestCase):
+    def test_whitespace_shares_key(self):
+        self.assertEqual(
+            normalize_query("speed of light"),
+            normalize_query(" speed  of\tlight "),
+        )
+
+    def test_case_is_kept(self):
+        self.assertNotEqual(normalize_query("G"), normalize_query("g"))
+        self.assertNotEqual(normalize_query("Mg"), normalize_query("mg"))
+
+
+if __name__ == "__main__":
+    unittest.main()